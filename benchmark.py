@@ -0,0 +1,360 @@
+import argparse
+import csv
+import datetime
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import main
+
+# Where the results of every stage are compared against (and saved to with --save-baseline)
+baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks", "baseline.json")
+
+# A stage is a regression when it takes tolerance times longer (or more memory) than in the baseline
+benchmark_tolerance = 1.5
+benchmark_scales = [1, 10, 100]
+benchmark_seed = 42
+
+# A query run from the command line, in a new interpreter (best of cold_start_runs), has to take less than the target
+cold_start_target_seconds = 0.5
+cold_start_runs = 3
+
+# Postgres type codes of the synthetic columns, like in cursor.description
+INT2, INT4, BYTEA, BPCHAR, VARCHAR, REAL, DATE = 21, 23, 17, 1042, 1043, 700, 1082
+
+# Sizes of the sample Northwind database, multiplied by the scale for orders, order details and products
+sample_sizes = {'orders': 830, 'products': 77, 'customers': 91, 'employees': 9, 'shippers': 6, 'categories': 8}
+
+
+class SyntheticConnection:
+    # The transactions of DbInput have nothing to commit or roll back without a database
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class SyntheticDbInput(main.DbInput):
+    # Stands in for DbInput: serves the synthetic tables the way a psycopg2 cursor would (tuples, dates as
+    # datetime.date and bytea as memoryview), so the extraction code of DbInput runs without a database.
+    def __init__(self, data_saver, tables):
+        self.tables = tables
+        super().__init__(data_saver)
+
+    def connect_db(self):
+        return SyntheticConnection()
+
+    def fetch_table_names(self):
+        return list(self.tables)
+
+    def fetch_table(self, table_name, connection, condition=""):
+        description, rows = self.tables[table_name]
+        return self.format_rows(description, list(rows))
+
+
+def generate_northwind(scale, seed=benchmark_seed):
+    # Deterministic Northwind-like tables: orders, order details and products grow with the scale.
+    # Returns the Postgres tables as {table_name: (description, rows)} and the rows of order_details.csv.
+    random_generator = random.Random(seed)
+    first_day = datetime.date(1996, 7, 4)
+
+    def text(prefix, number):
+        return f"{prefix} {number}"
+
+    categories = [(category_id, text("Category", category_id), text("Description of category", category_id),
+                   memoryview(b"")) for category_id in range(1, sample_sizes['categories'] + 1)]
+    shippers = [(shipper_id, text("Shipper", shipper_id), f"(503) 555-{shipper_id:04d}")
+                for shipper_id in range(1, sample_sizes['shippers'] + 1)]
+    employees = [(employee_id, text("Last name", employee_id), text("First name", employee_id), "Sales Representative",
+                  first_day - datetime.timedelta(days=10000 + employee_id * 100), memoryview(b""))
+                 for employee_id in range(1, sample_sizes['employees'] + 1)]
+    customers = [(f"C{customer_number:05d}", text("Company", customer_number), text("Contact", customer_number),
+                  text("City", customer_number % 70), random_generator.choice([None, "SP", "RJ", "WA", "BC"]),
+                  random_generator.choice(["Brazil", "Germany", "USA", "France", "UK", "Canada"]))
+                 for customer_number in range(sample_sizes['customers'])]
+
+    product_count = sample_sizes['products'] * scale
+    products = [(product_id, text("Product", product_id), random_generator.randint(1, 29),
+                 random_generator.randint(1, sample_sizes['categories']), f"{random_generator.randint(1, 48)} units",
+                 round(random_generator.uniform(2.5, 263.5), 2), random_generator.randint(0, 125),
+                 random_generator.randint(0, 100), random_generator.randint(0, 30), random_generator.randint(0, 1))
+                for product_id in range(1, product_count + 1)]
+
+    orders = []
+    order_details = []
+    for order_id in range(10248, 10248 + sample_sizes['orders'] * scale):
+        order_date = first_day + datetime.timedelta(days=random_generator.randint(0, 670))
+        shipped_date = None if random_generator.random() < 0.03 \
+            else order_date + datetime.timedelta(days=random_generator.randint(1, 35))
+        customer = random_generator.choice(customers)
+        orders.append((order_id, customer[0], random_generator.randint(1, sample_sizes['employees']), order_date,
+                       order_date + datetime.timedelta(days=28), shipped_date,
+                       random_generator.randint(1, sample_sizes['shippers']), round(random_generator.uniform(0, 1000), 2),
+                       customer[1], text("Street", order_id % 500), customer[3], customer[4],
+                       f"{random_generator.randint(10000, 99999)}", customer[5]))
+
+        # 2.6 details per order on average, like the sample, never the same product twice in an order
+        for product in random_generator.sample(products, random_generator.randint(1, 4)):
+            order_details.append((order_id, product[0], product[5], random_generator.randint(1, 120),
+                                  random_generator.choice([0, 0, 0, 0.05, 0.1, 0.15, 0.2, 0.25])))
+
+    tables = {
+        'categories': ([('category_id', INT2), ('category_name', VARCHAR), ('description', VARCHAR),
+                        ('picture', BYTEA)], categories),
+        'shippers': ([('shipper_id', INT2), ('company_name', VARCHAR), ('phone', VARCHAR)], shippers),
+        'employees': ([('employee_id', INT2), ('last_name', VARCHAR), ('first_name', VARCHAR), ('title', VARCHAR),
+                       ('birth_date', DATE), ('photo', BYTEA)], employees),
+        'customers': ([('customer_id', BPCHAR), ('company_name', VARCHAR), ('contact_name', VARCHAR),
+                       ('city', VARCHAR), ('region', VARCHAR), ('country', VARCHAR)], customers),
+        'products': ([('product_id', INT2), ('product_name', VARCHAR), ('supplier_id', INT2), ('category_id', INT2),
+                      ('quantity_per_unit', VARCHAR), ('unit_price', REAL), ('units_in_stock', INT2),
+                      ('units_on_order', INT2), ('reorder_level', INT2), ('discontinued', INT4)], products),
+        'orders': ([('order_id', INT2), ('customer_id', BPCHAR), ('employee_id', INT2), ('order_date', DATE),
+                    ('required_date', DATE), ('shipped_date', DATE), ('ship_via', INT2), ('freight', REAL),
+                    ('ship_name', VARCHAR), ('ship_address', VARCHAR), ('ship_city', VARCHAR),
+                    ('ship_region', VARCHAR), ('ship_postal_code', VARCHAR), ('ship_country', VARCHAR)], orders),
+    }
+    return tables, order_details
+
+
+def measure(results, scale, stage, rows, function, trace_memory=False):
+    # Runs a stage once, keeping its time and throughput, or, with trace_memory, only the peak memory it allocated
+    # on top of what was there: tracing slows the stages down too much for their time to mean anything.
+    # It is measured like the pipeline measures its steps, so the measurements of the pipeline inside the stage
+    # don't reset its peak.
+    with main.Metrics(trace_memory=trace_memory).measure(stage) as measurement:
+        function_result = function()
+
+    if not (function_result[0] if isinstance(function_result, tuple) else function_result):
+        raise Exception(f"Stage {stage} failed at scale {scale}.")
+
+    result = results.setdefault(f"{scale}x/{stage}", {})
+    if trace_memory:
+        result['peak_memory_bytes'] = measurement['peak_memory_bytes']
+    else:
+        seconds = measurement['wall_seconds']
+        result.update({'seconds': seconds, 'rows': rows, 'rows_per_second': rows / seconds if seconds > 0 else None})
+    return function_result
+
+
+def measure_cold_start(results, scale, date, runs=cold_start_runs):
+    # Runs `main.py query` in a new interpreter, the way cron and other services call it, from its start to its exit.
+    # Every run asks for another page, so none of them is answered by the query cache.
+    timings = []
+    for page in range(1, runs + 1):
+        started_at = time.perf_counter()
+        completed = subprocess.run([sys.executable, os.path.abspath(main.__file__), 'query', '--date', date,
+                                    '--page', str(page), '--page-size', '10'],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - started_at)
+        if completed.returncode != 0:
+            raise Exception(f"The cold start query failed at scale {scale} with status {completed.returncode}.")
+
+    seconds = min(timings)
+    results[f"{scale}x/cold_start_query"] = {
+        'seconds': seconds,
+        'rows': 10,
+        'rows_per_second': 10 / seconds,
+        'peak_memory_bytes': 0  # Not measured, it happens in another process
+    }
+
+
+def run_benchmark(scale, results, seed=benchmark_seed, trace_memory=False):
+    # Runs the stages of the pipeline on the synthetic data, in a temporary folder. A run times the stages,
+    # and a run with trace_memory measures their peak memory.
+    tables, order_details = generate_northwind(scale, seed)
+    database_rows = sum(len(rows) for _, rows in tables.values())
+    orders = len(tables['orders'][1])
+
+    previous_folder = os.getcwd()
+    previous_csv_file_path = main.csv_file_path
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        try:
+            main.csv_file_path = os.path.join(folder, "order_details.csv")
+            with open(main.csv_file_path, "w", newline='') as csv_file:
+                csv_writer = csv.writer(csv_file)
+                csv_writer.writerow(main.csv_columns)
+                csv_writer.writerows(order_details)
+
+            data_saver = main.DataSaver()
+            data_saver.db = SyntheticDbInput(data_saver, tables)
+            data_saver.csv = main.CsvInput(data_saver)
+            data_saver.extraction_state = main.ExtractionState()
+
+            _, data_saver.db_data = measure(results, scale, "fetch_and_save_all_data", database_rows,
+                                            data_saver.db.fetch_and_save_all_data, trace_memory)
+            data_saver.csv_streamed, _ = measure(results, scale, "save_csv_data", len(order_details),
+                                                 data_saver.csv.save_csv_data, trace_memory)
+            measure(results, scale, "write_db_data_to_disk", database_rows, data_saver.write_db_data_to_disk,
+                    trace_memory)
+
+            data_saver.load_saved_data_to_memory()
+            measure(results, scale, "create_new_database", database_rows + len(order_details),
+                    data_saver.create_new_database, trace_memory)
+            measure(results, scale, "query_orders", orders, data_saver.query_orders, trace_memory)
+            data_saver.reader.close()
+            if not trace_memory:
+                measure_cold_start(results, scale, data_saver.current_working_date)
+        finally:
+            main.csv_file_path = previous_csv_file_path
+            os.chdir(previous_folder)
+
+
+def write_partitions(data_saver, date, tables):
+    # Writes {table_name: (column_names, rows)} as the JSON partitions of a date, and records them in the manifest
+    for table_name, (column_names, rows) in tables.items():
+        category = "csv" if table_name == "order_details" else "postgres"
+        path = main.DataSaver.partition_file(category, "" if category == "csv" else table_name, "json", date)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as partition_file:
+            json.dump([dict(zip(column_names, row)) for row in rows], partition_file, indent=4, default=str)
+        data_saver.manifest.record(category, path)
+
+
+def check_warehouse(seed=benchmark_seed, dates=("2020-01-01", "2020-01-02", "2020-01-03")):
+    # Applies three dates to the warehouse out of order: the first two with the same tables, and the last one with an
+    # order changed and another one deleted. Then the middle one is applied again, unchanged (nothing to do) and
+    # changed (the warehouse is rewound to it, which opens again the rows the last date closed, and the last date is
+    # applied again). Every time, the orders queried as of each date have to be the ones of its merged database.
+    # Returns the differences found.
+    synthetic_tables, order_details = generate_northwind(1, seed)
+    tables = {table_name: ([column for column, _ in description], rows)
+              for table_name, (description, rows) in synthetic_tables.items() if table_name in ('orders', 'products')}
+    tables['order_details'] = (list(main.csv_columns), order_details)
+    order_columns, orders = tables['orders']
+    product_columns, products = tables['products']
+
+    changed_order = list(orders[0])
+    changed_order[order_columns.index('ship_city')] = "Changed city"
+    deleted_order_id = orders[5][order_columns.index('order_id')]
+    last_tables = {**tables, 'orders': (order_columns, [tuple(changed_order)] + orders[1:5] + orders[6:])}
+
+    changed_product = list(products[0])
+    changed_product[product_columns.index('unit_price')] = 999.5
+    changed_tables = {**tables, 'products': (product_columns, [tuple(changed_product)] + products[1:])}
+
+    first_date, middle_date, last_date = dates
+    differences = []
+    previous_folder = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        data_saver = main.DataSaver()
+        warehouse = main.DataSaver()
+        warehouse.storage_mode = "warehouse"
+        try:
+            def apply(date):
+                if not (warehouse.load_saved_data_to_memory(date)[0] and warehouse.create_new_database(date)):
+                    raise Exception(f"Applying {date} to the warehouse failed.")
+
+            def compare(stage):
+                for date in dates:
+                    if not (data_saver.load_saved_data_to_memory(date)[0] and data_saver.create_new_database(date)):
+                        raise Exception(f"Building the merged database of {date} failed.")
+                    expected = list(data_saver.find_orders(date))
+                    queried = list(warehouse.find_orders(date))
+                    if queried != expected:
+                        differences.append(f"{stage}: the orders as of {date} don't match its merged database")
+
+                    order_ids = {merged_order['order']['order_id'] for merged_order in queried}
+                    if (deleted_order_id in order_ids) != (date != last_date):
+                        differences.append(f"{stage}: order {deleted_order_id} is wrong as of {date}")
+
+            write_partitions(data_saver, first_date, tables)
+            write_partitions(data_saver, middle_date, tables)
+            write_partitions(data_saver, last_date, last_tables)
+            for date in (first_date, last_date, middle_date):
+                apply(date)
+            compare("applied out of order")
+
+            apply(middle_date)
+            compare("middle date applied again")
+
+            write_partitions(data_saver, middle_date, changed_tables)
+            apply(middle_date)
+            compare("middle date changed")
+        finally:
+            data_saver.reader.close()
+            warehouse.reader.close()
+            os.chdir(previous_folder)
+    return differences
+
+
+def compare_with_baseline(results, baseline, tolerance=benchmark_tolerance):
+    # Returns the stages that got slower, or took more memory, than tolerance times their baseline
+    regressions = []
+    for key, result in results.items():
+        expected = baseline.get(key)
+        if expected is None:
+            continue
+        for metric in ('seconds', 'peak_memory_bytes'):
+            if expected[metric] > 0 and result[metric] > expected[metric] * tolerance:
+                regressions.append(f"{key} {metric}: {result[metric]:.4g} (baseline {expected[metric]:.4g})")
+    return regressions
+
+
+def print_results(results, baseline):
+    print(f"{'stage':<36}{'seconds':>10}{'rows/s':>14}{'peak MiB':>10}{'vs baseline':>13}")
+    for key, result in results.items():
+        expected = baseline.get(key)
+        ratio = f"{result['seconds'] / expected['seconds']:.2f}x" if expected and expected['seconds'] > 0 else "-"
+        print(f"{key:<36}{result['seconds']:>10.3f}{result['rows_per_second'] or 0:>14,.0f}"
+              f"{result['peak_memory_bytes'] / 2 ** 20:>10.1f}{ratio:>13}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the pipeline stages on synthetic Northwind data')
+    parser.add_argument('--scales', help='Scales of the synthetic data (orders, order details and products).',
+                        type=int, nargs='+', default=benchmark_scales, required=False)
+    parser.add_argument('--seed', help='Seed of the synthetic data.', type=int, default=benchmark_seed,
+                        required=False)
+    parser.add_argument('--baseline', help='Baseline to compare the results with.', default=baseline_path,
+                        required=False)
+    parser.add_argument('--save-baseline', help='Save the results as the new baseline.', action='store_true',
+                        required=False)
+    parser.add_argument('--tolerance', help='How many times slower than the baseline a stage can be.',
+                        type=float, default=benchmark_tolerance, required=False)
+    parser.add_argument('--cold-start-target', help='Seconds a query run from the command line has to stay under.',
+                        type=float, default=cold_start_target_seconds, required=False)
+    args = parser.parse_args()
+
+    # Only the benchmark results are printed
+    logging.getLogger().setLevel(logging.WARNING)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    # The warehouse is checked first, its rewind has to give the same tables as the merged databases
+    differences = check_warehouse(args.seed)
+    if differences:
+        print("Warehouse check failed:\n  " + "\n  ".join(differences))
+        sys.exit(1)
+
+    results = {}
+    for scale in args.scales:
+        run_benchmark(scale, results, args.seed)
+        run_benchmark(scale, results, args.seed, trace_memory=True)
+
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as baseline_file:
+            json.dump({**baseline, **results}, baseline_file, indent=4)
+        print(f"Baseline saved to {args.baseline}")
+    else:
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        regressions += [f"{key} seconds: {result['seconds']:.4g} (target {args.cold_start_target:.4g})"
+                        for key, result in results.items()
+                        if key.endswith("/cold_start_query") and result['seconds'] > args.cold_start_target]
+        if regressions:
+            print("Regressions against the baseline:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
@@ -1,14 +1,28 @@
 import argparse
+import array
+import base64
+import contextlib
 import csv
 import datetime
+import gzip
+import hashlib
+import io
+import itertools
 import json
 import logging
 import os
+import pathlib
 import re
+import shutil
 import sqlite3
+import sys
+import tempfile
+import threading
 import time
-
-import psycopg2
+import tracemalloc
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 
 # Database connection parameters
 db_params = {
@@ -22,56 +36,532 @@ db_params = {
 # Csv path
 csv_file_path = "code-challenge-main/data/order_details.csv"
 
+# Expected header of the CSV, with the array type code of each column ('q' integer, 'd' float).
+# The CSV is read in chunks of csv_chunk_size rows.
+csv_columns = {'order_id': 'q', 'product_id': 'q', 'unit_price': 'd', 'quantity': 'q', 'discount': 'd'}
+csv_chunk_size = 50000
+array_value_parsers = {'q': int, 'd': float}
+array_column_types = {'q': 'INTEGER', 'd': 'REAL'}
+
+# Extraction mode for the Postgres tables:
+#  "memory" keeps every table in DataSaver.db_data until step 1.2 writes it to disk.
+#  "stream" reads every table through a server-side cursor and writes each batch as soon as it arrives.
+extraction_mode = "memory"
+extraction_batch_size = 5000
+
+# Number of tables extracted at the same time, each with its own pooled connection. 1 extracts them one by one.
+extraction_workers = 1
+
+# Extraction engine per Postgres table, "default" is used for every table not listed here:
+#  "rows" builds the rows in Python (through the extraction mode above).
+#  "copy" dumps the table with COPY ... TO STDOUT straight into a CSV file in the landing zone.
+extraction_engines = {
+    "default": "rows"
+}
+
+# Incremental extraction keeps a fingerprint of every table in the state folder. Tables that didn't change since the
+# previous run point to the previous partition, and tables that only got new rows only extract those rows.
+# The new rows are found through the high-water mark of a single integer primary key, or of the column set here.
+incremental_extraction = False
+incremental_keys = {}
+state_folder = "./state"
+
+# Format of the files written to ./data: "json" (rows) or "parquet" (typed columns, needs the pyarrow package)
+landing_format = "json"
+
+# Step 2.1 inserts the rows in batches of loader_batch_size, with a page cache of loader_cache_size_kib.
+# With more than one loader worker, the partitions are loaded by that many processes at the same time.
+loader_batch_size = 10000
+loader_cache_size_kib = 65536
+loader_workers = 1
+
+# Part of the build cache key of the merged databases: bump it whenever step 2.1 changes the tables it builds,
+# so the databases built by the previous version are rebuilt instead of reused.
+loader_version = 2
+
+# --compact keeps the partitions of the last data_retention_days days in ./data as they are, and moves the older ones
+# into one compressed archive per "week" or "month" in archive_folder. Identical partitions are archived once.
+data_retention_days = 30
+archive_period = "month"
+archive_folder = "./data/archive"
+
+# Number of independent steps of the pipeline that can run at the same time
+stage_workers = 4
+
+# Every run of the steps saves its metrics (time, rows and bytes of each step and table) in metrics_folder,
+# as "json" or as "prometheus" text. With metrics_trace_memory, the peak memory of each one is measured too,
+# through tracemalloc, which makes the pipeline several times slower while it traces.
+# The metrics of the runs older than metrics_max_age_days are deleted when a new run saves its own.
+metrics_folder = "./metrics"
+metrics_format = "json"
+metrics_trace_memory = False
+metrics_max_age_days = 30
+
+# Number of dates whose merged database is built at the same time by --backfill, each one in its own process
+backfill_workers = 4
+
+# Step 3 reads the merged databases through read-only connections, keeping the last reader_pool_size of them open.
+# The files are memory mapped up to reader_mmap_size bytes. The orders are read reader_fetch_size rows at a time.
+reader_pool_size = 4
+reader_mmap_size = 268435456
+reader_fetch_size = 1000
+
+# Indexes created in every merged database, used by the filters of step 3
+merged_database_indexes = {'orders': [('order_id',), ('customer_id',), ('order_date',)],
+                           'order_details': [('order_id', 'product_id')]}
+
+# Where step 2.1 merges the partitions of a date: "date" builds a whole merged database per date, "warehouse"
+# applies the date to a single warehouse_path database that keeps every version of the rows with the dates they
+# were valid on, so only the changed rows are written and any date can be queried from it.
+storage_mode = "date"
+warehouse_path = "./merged_databases/warehouse.db"
+
+# Primary keys of the tables in the warehouse. Each key has one current version of its row.
+warehouse_keys = {'categories': ('category_id',), 'customer_customer_demo': ('customer_id', 'customer_type_id'),
+                  'customer_demographics': ('customer_type_id',), 'customers': ('customer_id',),
+                  'employee_territories': ('employee_id', 'territory_id'), 'employees': ('employee_id',),
+                  'order_details': ('order_id', 'product_id'), 'orders': ('order_id',), 'products': ('product_id',),
+                  'region': ('region_id',), 'shippers': ('shipper_id',), 'suppliers': ('supplier_id',),
+                  'territories': ('territory_id',), 'us_states': ('state_id',)}
+# Columns the warehouse keeps the history of the rows in, hidden from the queries
+warehouse_columns = ('_valid_from', '_valid_to', '_row_hash')
+
+# Orders per page when step 3 is asked for a page
+query_page_size = 1000
+
+# Step 3 output: "json" is a single indented JSON array, "jsonl" streams one order per line.
+# Both can be compressed with "gzip" or "zstd" (needs the zstandard package).
+query_output_format = "json"
+query_output_compression = None
+query_output_suffixes = {'gzip': '.gz', 'zstd': '.zst'}
+
+# Step 3 reuses the output of the same query on the same merged database instead of writing it again.
+# The outputs are deleted once they are older than query_cache_max_age_days, or, least recently used first,
+# when all of them take more than query_cache_max_bytes.
+query_cache_max_bytes = 1024 * 1024 * 1024
+query_cache_max_age_days = 7
+
+# Maps Postgres type codes (cursor.description) to the types written in the header of the COPY files
+copy_column_types = {16: 'bool', 17: 'bytea', 20: 'int', 21: 'int', 23: 'int', 700: 'float', 701: 'float',
+                     1700: 'float'}
+copy_value_parsers = {'bool': lambda value: value == 't', 'int': int, 'float': float, 'str': str,
+                      'bytea': lambda value: bytes.fromhex(value[2:])}
+copy_null_value = '\\N'
+
+# Maps Postgres type codes to the SQLite types of the extracted tables, anything else is TEXT.
+# Dates and timestamps are written as YYYY-MM-DD. Binary (bytea) columns are kept as they come from psycopg2,
+# and written to JSON as {"$bytea": "<length>:<base64>"}, which step 2 reads back as bytes.
+postgres_column_types = {16: 'INTEGER', 17: 'BLOB', 20: 'INTEGER', 21: 'INTEGER', 23: 'INTEGER', 700: 'REAL',
+                         701: 'REAL', 1700: 'REAL'}
+postgres_date_types = {1082, 1114, 1184}
+json_binary_key = "$bytea"
+
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
+def import_psycopg2():
+    # psycopg2 is only imported by the steps reading from Postgres, so the other commands start faster
+    import psycopg2
+    import psycopg2.extensions
+    import psycopg2.pool
+    return psycopg2
+
+
+def spawn_process_pool(max_workers):
+    # Process pools are only used by step 2.1 and --backfill, so multiprocessing is imported when they are.
+    # The workers are spawned, so they start from a fresh interpreter on every platform.
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def import_pyarrow():
+    # pyarrow is only needed by the parquet landing format, so it stays an optional dependency
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception("The parquet landing format needs the pyarrow package: pip install pyarrow")
+    return pyarrow, pyarrow.parquet
+
+
+def open_partition(path):
+    # Opens a partition for reading, as bytes. Partitions moved to an archive by --compact are found through the
+    # manifest, so they are read from the same path as before.
+    if os.path.exists(path):
+        return open(path, 'rb')
+
+    partition = PartitionManifest().find_path(path)
+    if partition is None or partition['archive'] is None:
+        raise FileNotFoundError(f"Partition {path} wasn't found.")
+    with zipfile.ZipFile(partition['archive']) as archive:
+        return io.BytesIO(archive.read(PartitionManifest.archive_member(partition)))
+
+
+def partition_size(path):
+    # Size of a partition file, the one it had before being archived for archived partitions
+    if os.path.exists(path):
+        return os.path.getsize(path)
+    partition = PartitionManifest().find_path(path)
+    return partition['byte_size'] if partition is not None else None
+
+
+def load_partition_into_database(path, database_path):
+    # Worker process of step 2.1: loads a single partition into its own database
+    db_connection = sqlite3.connect(database_path)
+    try:
+        db_connection.execute("PRAGMA journal_mode=OFF;")
+        db_connection.execute("PRAGMA synchronous=OFF;")
+        DataSaver().create_table_from_data(path, db_connection)
+    finally:
+        db_connection.close()
+    return database_path
+
+
+class Metrics:
+    # Measures the steps and the work done per table inside them: wall and CPU time, rows, bytes, rows per second
+    # and, with trace_memory, the peak of the memory Python allocated while each of them ran, on top of what was
+    # allocated before. Steps run on threads, so the CPU time is the thread's, and the memory of the steps running
+    # at the same time counts in each other's peak. The memory is traced by tracemalloc while a Metrics with
+    # trace_memory is measuring anything.
+    # Measurements open in every Metrics, as [memory at the start, peak], so nested ones all get their peak
+    open_measurements = []
+    tracing_lock = threading.Lock()
+    started_tracing = False
+
+    def __init__(self, folder=metrics_folder, output_format=metrics_format, trace_memory=metrics_trace_memory,
+                 max_age_days=metrics_max_age_days):
+        self.folder = folder
+        self.output_format = output_format
+        self.trace_memory = trace_memory
+        self.max_age_days = max_age_days
+        self.measurements = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def measure(self, stage, name=""):
+        # The code measured can set measurement['rows'] and measurement['bytes']
+        measurement = {'stage': stage, 'name': name, 'rows': None, 'bytes': None}
+        memory = self.start_memory_peak() if self.trace_memory else None
+        started_at = time.perf_counter()
+        cpu_started_at = time.thread_time()
+        try:
+            yield measurement
+            measurement['succeeded'] = True
+        except BaseException:
+            measurement['succeeded'] = False
+            raise
+        finally:
+            measurement['wall_seconds'] = time.perf_counter() - started_at
+            measurement['cpu_seconds'] = time.thread_time() - cpu_started_at
+            measurement['rows_per_second'] = measurement['rows'] / measurement['wall_seconds'] \
+                if measurement['rows'] is not None and measurement['wall_seconds'] > 0 else None
+            measurement['peak_memory_bytes'] = self.stop_memory_peak(memory) if memory is not None else None
+            with self.lock:
+                self.measurements.append(measurement)
+
+    @classmethod
+    def update_memory_peaks(cls):
+        # The peak since the last reset goes to every open measurement, before a new peak starts
+        _, peak = tracemalloc.get_traced_memory()
+        for memory in cls.open_measurements:
+            memory[1] = max(memory[1], peak)
+        tracemalloc.reset_peak()
+
+    @classmethod
+    def start_memory_peak(cls):
+        with cls.tracing_lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                cls.started_tracing = True
+            cls.update_memory_peaks()
+            current, _ = tracemalloc.get_traced_memory()
+            memory = [current, current]
+            cls.open_measurements.append(memory)
+            return memory
+
+    @classmethod
+    def stop_memory_peak(cls, memory):
+        # Returns the peak of the measurement, and stops tracing once nothing is measured (unless it was already on)
+        with cls.tracing_lock:
+            cls.update_memory_peaks()
+            cls.open_measurements = [open_memory for open_memory in cls.open_measurements if open_memory is not memory]
+            if not cls.open_measurements and cls.started_tracing:
+                tracemalloc.stop()
+                cls.started_tracing = False
+            return memory[1] - memory[0]
+
+    def add(self, measurements):
+        # Measurements taken in another process, like the workers of --backfill
+        with self.lock:
+            self.measurements.extend(measurements)
+
+    def save(self):
+        # Writes the measurements of the run to metrics/run_<timestamp>_<pid>.<json|prom> and starts over.
+        # The timestamp goes down to the microsecond, so runs started at the same time get their own file.
+        with self.lock:
+            measurements, self.measurements = self.measurements, []
+        if not measurements:
+            return None
+
+        os.makedirs(self.folder, exist_ok=True)
+        now = datetime.datetime.now()
+        file_name = f"run_{now.strftime('%Y-%m-%d_%H-%M-%S-%f')}_{os.getpid()}"
+        if self.output_format == "prometheus":
+            path = os.path.join(self.folder, file_name + ".prom")
+            lines = []
+            for metric in ('wall_seconds', 'cpu_seconds', 'rows', 'bytes', 'rows_per_second', 'peak_memory_bytes'):
+                lines.append(f"# TYPE pipeline_{metric} gauge")
+                for measurement in measurements:
+                    if measurement[metric] is not None:
+                        labels = f'stage="{measurement["stage"]}",name="{measurement["name"]}"'
+                        lines.append(f"pipeline_{metric}{{{labels}}} {measurement[metric]}")
+            with open(path, "w") as metrics_file:
+                metrics_file.write("\n".join(lines) + "\n")
+        else:
+            path = os.path.join(self.folder, file_name + ".json")
+            with open(path, "w") as metrics_file:
+                json.dump({'generated_at': now.isoformat(), 'measurements': measurements}, metrics_file, indent=4)
+
+        logging.info(f"Metrics of the run saved to {path}")
+        self.prune()
+        return path
+
+    def prune(self):
+        # Deletes the metrics of the runs older than max_age_days
+        expires_at = time.time() - self.max_age_days * 86400
+        for file_name in os.listdir(self.folder):
+            path = os.path.join(self.folder, file_name)
+            # Another run can be pruning the same files
+            with contextlib.suppress(FileNotFoundError):
+                if file_name.startswith("run_") and os.path.getmtime(path) < expires_at:
+                    os.remove(path)
+
+
+def build_database_for_date(date, settings, trace_memory=metrics_trace_memory):
+    # Runs in a worker process of the backfill: builds the merged database of a single date, with the settings
+    # of the DataSaver running the backfill. Its measurements are returned, to be saved with the backfill's.
+    data_saver = DataSaver()
+    for name, value in settings.items():
+        setattr(data_saver, name, value)
+    data_saver.metrics.trace_memory = trace_memory
+    started_at = time.perf_counter()
+    succeeded = data_saver.reprocess_data(date)
+    return succeeded, time.perf_counter() - started_at, data_saver.metrics.measurements
+
+
+class StageScheduler:
+    # Runs the steps of the pipeline as a DAG on a thread pool. A step depends on the steps producing its inputs:
+    # it starts as soon as all of them succeeded, and is skipped if any of them failed.
+    # Steps with 'checkpoint' write their output to disk: once they succeed, a rerun for the same date after an
+    # interrupted run skips them. When a run finishes without errors, the checkpoints of its steps are cleared,
+    # with the ones of the partitions they write ('partitions' is their category), and the others are kept.
+    # With metrics, every step is measured and the metrics are saved at the end of each run.
+    def __init__(self, steps, max_workers=stage_workers, checkpoints=None, metrics=None):
+        self.steps = steps
+        self.max_workers = max_workers
+        self.checkpoints = checkpoints
+        self.metrics = metrics
+
+        self.producers = {}
+        for step in steps:
+            for output in step['outputs']:
+                if output in self.producers:
+                    raise ValueError(f"{output} is produced by step {self.producers[output]} and step {step['step']}")
+                self.producers[output] = step['step']
+
+        for step in steps:
+            for step_input in step['inputs']:
+                if step_input not in self.producers:
+                    raise ValueError(f"Step {step['step']} needs {step_input}, but no step produces it")
+        self.check_for_cycles()
+
+    def dependencies(self, step, selected_steps):
+        # Inputs produced by steps that aren't part of this run are expected to be there already (like ./data)
+        return {self.producers[step_input] for step_input in step['inputs']
+                if self.producers[step_input] in selected_steps}
+
+    def check_for_cycles(self):
+        all_steps = {step['step'] for step in self.steps}
+        remaining = {step['step']: self.dependencies(step, all_steps) for step in self.steps}
+        while remaining:
+            ready = [step for step, dependencies in remaining.items() if not dependencies & remaining.keys()]
+            if not ready:
+                raise ValueError(f"The steps {sorted(remaining)} depend on each other")
+            for step in ready:
+                del remaining[step]
+
+    def run(self, selected_steps=None):
+        # Returns the result of every step: True (success), False (error) or None (skipped)
+        steps = [step for step in self.steps if selected_steps is None or step['step'] in selected_steps]
+        step_numbers = {step['step'] for step in steps}
+        pending = {step['step']: step for step in steps}
+        dependencies = {step['step']: self.dependencies(step, step_numbers) for step in steps}
+
+        now = datetime.datetime.now()
+        run_date = now.strftime("%Y-%m-%d")
+
+        results = {}
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for number, step in list(pending.items()):
+                    failed = [dependency for dependency in dependencies[number]
+                              if dependency in results and results[dependency] is not True]
+                    if failed:
+                        del pending[number]
+                        results[number] = None
+                        logging.warning(f"Step {number} was skipped because step {failed[0]} didn't succeed.")
+                    elif all(results.get(dependency) is True for dependency in dependencies[number]):
+                        del pending[number]
+                        if self.is_checkpointed(step, run_date):
+                            results[number] = True
+                            logging.info(f"Step {number} was already completed by an interrupted run, skipping it.")
+                        else:
+                            running[executor.submit(self.run_step, step)] = number
+
+                if running:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        number = running.pop(future)
+                        results[number] = future.result()
+                        if results[number] and self.checkpoints is not None and self.find(number).get('checkpoint'):
+                            self.checkpoints.mark_done(run_date, 'step', number)
+
+        if self.checkpoints is not None and all(results.values()):
+            self.checkpoints.clear(run_date, step_numbers,
+                                   {step['partitions'] for step in steps if 'partitions' in step})
+        if self.metrics is not None:
+            self.metrics.save()
+        return results
+
+    def is_checkpointed(self, step, run_date):
+        return self.checkpoints is not None and step.get('checkpoint', False) \
+            and self.checkpoints.is_done(run_date, 'step', step['step'])
+
+    def find(self, number):
+        return next(step for step in self.steps if step['step'] == number)
+
+    def run_step(self, step):
+        # This runs the function saved in the step. A step fails if it raises or returns a falsy result
+        # (or a tuple starting with one).
+        try:
+            if self.metrics is None:
+                function_result = step['function']()
+            else:
+                with self.metrics.measure('step', step['step']):
+                    function_result = step['function']()
+            succeeded = bool(function_result[0] if isinstance(function_result, tuple) else function_result)
+        except Exception as e:
+            logging.error(e)
+            succeeded = False
+
+        # Results text depends from the function_result
+        result = f'Step {step["step"]} was finished Successfully' if succeeded else f'Step {step["step"]} had a error.'
+        logging.info(f"\nStep: {step['step']}/{self.steps[-1]['step']}\n"
+                     f" Name: {step['name']}\n"
+                     f"  Description: {step['description']}\n\n"
+                     f" Result: {result}\n")
+        return succeeded
+
+
 class DataSaver:
     def __init__(self):
         self.db = None
         self.csv = None
         self.db_data = {}
-        self.csv_data = {}
+        # Whether step 1.1.2 wrote the CSV to disk, chunk by chunk as it read it
+        self.csv_streamed = False
         self.local_data = []
+        self.manifest = PartitionManifest()
+        self.reader = MergedDatabaseReader()
+        self.query_cache = QueryCache()
+        self.warehouse = Warehouse()
+        # Tables that step 1.1 already wrote to disk by itself (stream mode and COPY engine)
+        self.streamed_tables = []
         self.current_working_date = ''
-
+        self.extraction_mode = extraction_mode
+        self.extraction_batch_size = extraction_batch_size
+        self.extraction_workers = extraction_workers
+        self.extraction_engines = dict(extraction_engines)
+        self.incremental_extraction = incremental_extraction
+        self.extraction_state = None
+        self.query_output_format = query_output_format
+        self.landing_format = landing_format
+        self.loader_workers = loader_workers
+        self.storage_mode = storage_mode
+        self.query_output_compression = query_output_compression
+
+        # The pipeline is a DAG: a step runs once every step producing one of its inputs has succeeded,
+        # so the Postgres and the CSV branches of step 1 run at the same time.
         self.steps = [
             {
                 'step': '1',
                 'name': 'Initialize Data Sources',
                 'description': 'This sets up a connection with the Postgres DB and reads the CSV data.',
                 'function': self.initialize_data_sources,
-                'additional_steps': [
-                    {
-                        'step': '1.1',
-                        'name': 'Extract data from Data Sources',
-                        'description': 'This loads into memory the needed data from the DB and the CSV to be processed.',
-                        'function': self.extract_data_from_sources
-                    },
-                    {
-                        'step': '1.2',
-                        'name': 'Write data to disk',
-                        'description': 'This takes the data loaded to the memory, and writes to disk, '
-                                       'creating a new folder for every table in the database.\n'
-                                       '  It then saves the file inside a new folder, '
-                                       'created with the current date with the filename retrieved from the table and filetype "json".',
-                        'function': self.write_datas_to_disk
-                    }
-                ]
+                'inputs': [],
+                'outputs': ['data_sources']
+            },
+            {
+                'step': '1.1.1',
+                'name': 'Extract data from the Postgres DB',
+                'description': 'This loads into memory the needed data from the DB to be processed.',
+                'function': self.extract_db_data,
+                'inputs': ['data_sources'],
+                'outputs': ['db_data'],
+                'partitions': 'postgres'
+            },
+            {
+                'step': '1.1.2',
+                'name': 'Extract data from the CSV',
+                'description': 'This reads the CSV in chunks, writing each chunk to disk as soon as it is read.',
+                'function': self.extract_csv_data,
+                'inputs': ['data_sources'],
+                'outputs': ['csv_data'],
+                'partitions': 'csv'
+            },
+            {
+                'step': '1.2.1',
+                'name': 'Write the Postgres data to disk',
+                'description': 'This takes the data loaded to the memory, and writes to disk, '
+                               'creating a new folder for every table in the database.\n'
+                               '  It then saves the file inside a new folder, '
+                               'created with the current date with the filename retrieved from the table and filetype "json".',
+                'function': self.write_db_data_to_disk,
+                'inputs': ['db_data'],
+                'outputs': ['db_partitions'],
+                'partitions': 'postgres',
+                'checkpoint': True
+            },
+            {
+                'step': '1.2.2',
+                'name': 'Write the CSV data to disk',
+                'description': 'This checks the CSV data was written to disk by step 1.1.2, '
+                               'inside a new folder created with the current date.',
+                'function': self.write_csv_data_to_disk,
+                'inputs': ['csv_data'],
+                'outputs': ['csv_partitions'],
+                'partitions': 'csv',
+                'checkpoint': True
             },
             {
                 'step': '2',
                 'name': 'Load saved data from disk to memory',
                 'description': 'This loads the saved data (paths) into memory to be processed.',
                 'function': self.load_saved_data_to_memory,
-                'additional_steps': [
-                    {
-                        'step': '2.1',
-                        'name': 'Save the data from memory to the new database',
-                        'description': 'This loops trough ALL data paths, creating tables and columns programatically.\n'
-                                       '  Essentially, this merge the two data from CSV and database into one final database.',
-                        'function': self.create_new_database
-                    }
-                ]
+                'inputs': ['db_partitions', 'csv_partitions'],
+                'outputs': ['local_data']
+            },
+            {
+                'step': '2.1',
+                'name': 'Save the data from memory to the new database',
+                'description': 'This loops trough ALL data paths, creating tables and columns programatically.\n'
+                               '  Essentially, this merge the two data from CSV and database into one final database.',
+                'function': self.create_new_database,
+                'inputs': ['local_data'],
+                'outputs': ['merged_database'],
+                'checkpoint': True
             },
             {
                 'step': '3',
@@ -79,17 +569,25 @@ class DataSaver:
                 'description': 'This querys the orders and details from the merged database.\n'
                                '  It then saves the query to /query_output/ with the formatting: query_YYYY-MM-DD_generated_at_YYYY-MM-DD_HH-MM-SS.json',
                 'function': self.query_orders,
-                'additional_steps': []
+                'inputs': ['merged_database'],
+                'outputs': ['query_output'],
+                'checkpoint': True
             }
         ]
+        self.checkpoints = CheckpointStore()
+        self.metrics = Metrics()
+        self.scheduler = StageScheduler(self.steps, max_workers=stage_workers, checkpoints=self.checkpoints,
+                                        metrics=self.metrics)
 
     def initialize_data_sources(self):
         try:
             self.db = DbInput(self)
             self.csv = CsvInput(self)
+            self.extraction_state = ExtractionState()
             self.db_data = {}
-            self.csv_data = {}
+            self.csv_streamed = False
             self.local_data = []
+            self.streamed_tables = []
             self.current_working_date = ''
             return True
         except Exception as e:
@@ -104,98 +602,395 @@ class DataSaver:
         try:
             os.makedirs('./merged_databases', exist_ok=True)
 
-            formatted_date = date
-            if date == "":
+            # Without a date, the database is named after the date step 2 loaded
+            formatted_date = date or self.current_working_date
+            if formatted_date == "":
                 now = datetime.datetime.now()
                 formatted_date = now.strftime("%Y-%m-%d")
 
-            if os.path.exists(f'./merged_databases/merged_database_date-{formatted_date}.db'):
-                os.remove(f'./merged_databases/merged_database_date-{formatted_date}.db')
+            if self.storage_mode == "warehouse":
+                return self.update_warehouse(formatted_date)
+
+            database_path = f'./merged_databases/merged_database_date-{formatted_date}.db'
 
-                logging.warning(
-                    f"Database merged_database_date-{formatted_date}.db removed as it is being regenerated.\n")
+            # The database is built in a separate file and only replaces the current one once it is complete.
+            # A partial database left by an interrupted run is resumed.
+            partial_path = database_path + '.partial'
+            checksums = {path: (self.manifest.find_path(path) or {}).get('checksum') for path in self.local_data}
 
-            db_connection = sqlite3.connect(f'./merged_databases/merged_database_date-{formatted_date}.db')
+            # Build cache: a merged database keeps the checksum of every partition loaded into it, and the loader
+            # version in its user_version. If both match the partitions of the date, the database is reused as is.
+            # Otherwise only the tables whose partitions changed are reloaded, in a copy of the current database.
+            if not os.path.exists(partial_path):
+                build_key = self.read_build_key(database_path)
+                if build_key == (loader_version, checksums):
+                    logging.info(f"Database merged_database_date-{formatted_date}.db is up to date, reusing it.\n")
+                    return True
+                if build_key is not None and build_key[0] == loader_version:
+                    shutil.copyfile(database_path, partial_path)
+
+            build_key = self.read_build_key(partial_path)
+            if os.path.exists(partial_path) and (build_key is None or build_key[0] != loader_version):
+                logging.warning(f"Partial database of {formatted_date} was built by another loader, starting over.")
+                for leftover_path in (partial_path, partial_path + '-wal', partial_path + '-shm'):
+                    if os.path.exists(leftover_path):
+                        os.remove(leftover_path)
+
+            db_connection = sqlite3.connect(partial_path)
+            db_connection.execute(f"PRAGMA user_version = {loader_version};")
+            db_connection.execute("CREATE TABLE IF NOT EXISTS _loaded_partitions (path TEXT PRIMARY KEY, checksum TEXT)")
+            loaded_partitions = dict(db_connection.execute("SELECT path, checksum FROM _loaded_partitions"))
+
+            # A table is reloaded when one of its partitions changed or isn't part of the date anymore
+            changed_tables = {os.path.basename(path).split('.')[0] for path, checksum in loaded_partitions.items()
+                              if checksums.get(path, '') != checksum}
+            for path in list(loaded_partitions):
+                if os.path.basename(path).split('.')[0] in changed_tables:
+                    db_connection.execute("DELETE FROM _loaded_partitions WHERE path = ?", (path,))
+                    del loaded_partitions[path]
+            for table_name in sorted(changed_tables):
+                db_connection.execute(f"DROP TABLE IF EXISTS {table_name}")
+            db_connection.commit()
+
+            if loaded_partitions:
+                logging.info(f"Reusing {len(loaded_partitions)} of {len(self.local_data)} partitions in the database "
+                             f"of {formatted_date}" + (f", reloading {', '.join(sorted(changed_tables))}."
+                                                       if changed_tables else "."))
+
+            # Bulk load settings: write-ahead log without fsync on every commit and a bigger page cache while the
+            # database is built. Every loaded partition is committed with its checkpoint, so a crash in the middle
+            # leaves a consistent partial database that the next run picks up.
+            db_connection.execute("PRAGMA journal_mode=WAL;")
+            db_connection.execute("PRAGMA synchronous=NORMAL;")
+            db_connection.execute(f"PRAGMA cache_size=-{loader_cache_size_kib};")
+
+            pending_partitions = [path for path in self.local_data if path not in loaded_partitions]
+            if self.loader_workers > 1 and len(pending_partitions) > 1:
+                self.load_partitions_in_parallel(db_connection, pending_partitions, checksums)
+            else:
+                for path in pending_partitions:
+                    self.create_table_from_data(path, db_connection, checksum=checksums.get(path), checkpoint=True)
 
-            for path in self.local_data:
-                self.create_table_from_data(path, db_connection)
+            self.create_indexes(db_connection)
+            db_connection.commit()
 
+            # Back to the safe defaults for whoever opens the database next
+            db_connection.execute("PRAGMA journal_mode=DELETE;")
+            db_connection.execute("PRAGMA synchronous=FULL;")
+            db_connection.execute("PRAGMA cache_size=-2000;")
             db_connection.close()
 
+            if os.path.exists(database_path):
+                logging.warning(f"Database merged_database_date-{formatted_date}.db replaced as it was regenerated.\n")
+            os.replace(partial_path, database_path)
+
+            # The queries answered by the previous database may not hold anymore
+            self.query_cache.invalidate(formatted_date, keep_database_id=self.database_id(formatted_date))
+
             logging.info(f"Created database with name: merged_database_date-{formatted_date}.db\n")
             return True
         except Exception as e:
             logging.error(e)
             return False
 
-    def create_table_from_data(self, dir, connection):
-        # Connect to the SQLite database
-        db_cursor = connection.cursor()
-        with open(dir, 'r') as file:
-            json_data = json.load(file)
+    def update_warehouse(self, date):
+        # Applies the partitions of a date to the warehouse, in a single transaction. The dates have to be applied
+        # in order, so when the date was already applied from other partitions, or later dates were, the warehouse is
+        # rewound to the date and the later dates are applied again on top of it.
+        checksums = {path: (self.manifest.find_path(path) or {}).get('checksum') for path in self.local_data}
 
-            column_data_types = {'int': 'INTEGER', 'str': 'TEXT', 'float': 'REAL'}  # Map data types
-            table_name = dir.split('\\')[-1].split('.')[0]  # Assuming file name is table name
-
-            # Insert data into the table
-            for row in json_data:
-                # Extract schema information from the JSON data
-                column_names = row.keys()  # Assuming first item contains column names
-
-                # Generate the CREATE TABLE SQL statement
-                create_table_sql = f"CREATE TABLE IF NOT EXISTS {table_name} ("
-                for column_name in column_names:
-                    column_data_type = column_data_types.get(type(row[column_name]).__name__, 'TEXT')
-                    create_table_sql += f"{column_name} {column_data_type}, "
-                create_table_sql = create_table_sql.rstrip(', ') + ")"
-
-                # Execute the SQL statement to create the table
-                db_cursor.execute(create_table_sql)
-
-                insert_sql = f"INSERT INTO {table_name} ({', '.join(row.keys())}) VALUES ({', '.join(['?'] * len(row.values()))})"
+        connection = self.warehouse.connect()
+        try:
+            applied_dates = self.warehouse.applied_dates(connection)
+            if applied_dates and connection.execute("PRAGMA user_version;").fetchone()[0] != loader_version:
+                logging.warning("The warehouse was built by another loader, applying all its dates again.")
+                rewind_date = min(applied_dates)
+            elif applied_dates.get(date) == checksums:
+                logging.info(f"Date {date} is up to date in the warehouse.\n")
+                return True
+            else:
+                rewind_date = date
+
+            dates_to_apply = {applied_date: None for applied_date in applied_dates if applied_date >= rewind_date}
+            dates_to_apply[date] = self.local_data
+
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                if any(applied_date >= rewind_date for applied_date in applied_dates):
+                    self.warehouse.rewind(connection, rewind_date)
+
+                for applied_date in sorted(dates_to_apply):
+                    paths = dates_to_apply[applied_date]
+                    if paths is None:
+                        paths = [partition['path'] for partition in self.manifest.find(applied_date)]
+                        if not paths:
+                            logging.warning(f"The partitions of {applied_date} weren't found, "
+                                            f"removing it from the warehouse.")
+                            continue
+                        logging.info(f"Applying {applied_date} to the warehouse again.")
+                    self.apply_date_to_warehouse(connection, applied_date, paths)
+
+                connection.execute(f"PRAGMA user_version = {loader_version};")
+                self.create_indexes(connection)
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        except Exception as e:
+            logging.error(e)
+            return False
+        finally:
+            connection.close()
+
+        # The queries answered before may not hold anymore
+        for applied_date in dates_to_apply:
+            self.query_cache.invalidate(applied_date, keep_database_id=self.database_id(applied_date))
+
+        logging.info(f"Applied {date} to the warehouse {self.warehouse.path}\n")
+        return True
+
+    def apply_date_to_warehouse(self, connection, date, paths):
+        # The partitions are full snapshots of their tables. A table without a partition on the date is left as it is.
+        checksums = {}
+        for path in paths:
+            partition = self.manifest.find_path(path) or {}
+            checksums[path] = partition.get('checksum')
+
+            table_name = os.path.basename(path).split('.')[0]
+            with self.metrics.measure('load', table_name) as measurement:
+                measurement['bytes'] = partition_size(path)
+                column_names, column_types, rows = self.read_table_from_file(path)
+                if not column_names:
+                    continue
+                measurement['rows'], inserted, closed = self.warehouse.apply_table(connection, date, table_name,
+                                                                                   column_names, column_types, rows)
+            if inserted or closed:
+                logging.info(f"Table {table_name} on {date}: {inserted} rows inserted, {closed} rows closed.")
+
+        connection.execute("INSERT OR REPLACE INTO _applied_dates VALUES (?, ?)", (date, json.dumps(checksums)))
+
+    def merged_tables(self, date, table_names):
+        # Database holding the merged tables of a date, and the WITH clause to put in front of the queries reading
+        # them, which in warehouse mode reads the tables as they were on that date
+        if self.storage_mode == "warehouse":
+            if self.warehouse.build_key(date) is None:
+                raise Exception("Date don't match with database.")
+            return self.warehouse.path, self.warehouse.as_of(date, table_names)
+
+        database_path = f'./merged_databases/merged_database_date-{date}.db'
+        if not os.path.exists(database_path):
+            raise Exception("Date don't match with database.")
+        return database_path, ""
+
+    def database_id(self, date):
+        # Identifies a build of the merged database of a date by its build key, so a database rebuilt from the same
+        # partitions keeps its id. None if there is no database for the date.
+        if self.storage_mode == "warehouse":
+            build_key = self.warehouse.build_key(date)
+        else:
+            build_key = self.read_build_key(f'./merged_databases/merged_database_date-{date}.db')
+        if build_key is None:
+            return None
+        return hashlib.sha256(json.dumps(build_key, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def create_indexes(connection):
+        # Indexes are created after the rows are loaded, which is faster than keeping them up to date on every insert
+        for table_name, indexes in merged_database_indexes.items():
+            table_columns = {column[1] for column in connection.execute(f"PRAGMA table_info({table_name})")}
+            for index_columns in indexes:
+                if set(index_columns) <= table_columns:
+                    connection.execute(f"CREATE INDEX IF NOT EXISTS {table_name}_by_{'_'.join(index_columns)} "
+                                       f"ON {table_name} ({', '.join(index_columns)})")
+
+    @staticmethod
+    def read_build_key(database_path):
+        # Loader version and partition checksums a merged database was built from, None if there is none
+        if not os.path.exists(database_path):
+            return None
+
+        connection = sqlite3.connect(database_path)
+        try:
+            version = connection.execute("PRAGMA user_version;").fetchone()[0]
+            return version, dict(connection.execute("SELECT path, checksum FROM _loaded_partitions"))
+        except sqlite3.Error:
+            return None
+        finally:
+            connection.close()
+
+    def load_partitions_in_parallel(self, connection, paths, checksums):
+        # The partitions don't depend on each other, so each one is loaded into its own temporary database
+        # by a worker process. They are then copied into the merged database, in order, with one INSERT ... SELECT.
+        with tempfile.TemporaryDirectory(dir='./merged_databases') as temp_folder:
+            with spawn_process_pool(self.loader_workers) as executor:
+                futures = [executor.submit(load_partition_into_database, path, os.path.join(temp_folder, f"{i}.db"))
+                           for i, path in enumerate(paths)]
+
+                for path, future in zip(paths, futures):
+                    connection.execute("ATTACH DATABASE ? AS partition_db", (future.result(),))
+                    try:
+                        tables = connection.execute(
+                            "SELECT name, sql FROM partition_db.sqlite_master WHERE type = 'table'").fetchall()
+                        for table_name, create_table_sql in tables:
+                            if connection.execute("SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name = ?",
+                                                  (table_name,)).fetchone() is None:
+                                connection.execute(create_table_sql)
+
+                            column_names = ", ".join(column[1] for column in connection.execute(
+                                f"PRAGMA partition_db.table_info({table_name})"))
+                            with self.metrics.measure('load', table_name) as measurement:
+                                measurement['rows'] = connection.execute(
+                                    f"INSERT INTO main.{table_name} ({column_names}) "
+                                    f"SELECT {column_names} FROM partition_db.{table_name}").rowcount
+                                measurement['bytes'] = partition_size(path)
+                        connection.execute("INSERT OR REPLACE INTO _loaded_partitions VALUES (?, ?)",
+                                           (path, checksums.get(path)))
+                        connection.commit()
+                    finally:
+                        connection.execute("DETACH DATABASE partition_db")
+
+    def create_table_from_data(self, dir, connection, checksum=None, checkpoint=False):
+        # With checkpoint, the partition is recorded as loaded in the same transaction as its rows
+        table_name = os.path.basename(dir).split('.')[0]  # Assuming file name is table name
+        with self.metrics.measure('load', table_name) as measurement:
+            measurement['rows'], measurement['bytes'] = 0, partition_size(dir)
+
+            # Connect to the SQLite database
+            db_cursor = connection.cursor()
+            column_names, column_types, rows = self.read_table_from_file(dir)
+
+            if checkpoint:
+                db_cursor.execute("INSERT OR REPLACE INTO _loaded_partitions VALUES (?, ?)", (dir, checksum))
+            if not column_names:
+                connection.commit()
+                return
+
+            # Generate the CREATE TABLE SQL statement
+            columns_sql = ", ".join(f"{column_name} {column_type}"
+                                    for column_name, column_type in zip(column_names, column_types))
+            db_cursor.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ({columns_sql})")
+
+            # Insert data into the table, in batches and inside a single transaction
+            insert_sql = f"INSERT INTO {table_name} ({', '.join(column_names)}) VALUES ({', '.join(['?'] * len(column_names))})"
+            while True:
+                batch = list(itertools.islice(rows, loader_batch_size))
+                if not batch:
+                    break
+                db_cursor.executemany(insert_sql, batch)
+                measurement['rows'] += len(batch)
+
+            # Commit changes
+            connection.commit()
+
+    def read_table_from_file(self, path):
+        # Returns the column names, their SQLite types and an iterator over the rows as tuples
+        if path.endswith('.parquet'):
+            # Typed columns: the schema comes from the file and no row has to be parsed
+            pyarrow, parquet = import_pyarrow()
+            with open_partition(path) as file:
+                table = parquet.read_table(file)
+            return table.column_names, self.parquet_column_types(pyarrow, table.schema), \
+                zip(*(column.to_pylist() for column in table.columns))
+
+        table = self.read_rows_from_file(path)
+
+        # The schema is inferred once, from every row of the table
+        column_names, column_types = self.infer_schema(table)
+        return column_names, column_types, iter(table.records)
+
+    @staticmethod
+    def parquet_column_types(pyarrow, schema):
+        return ['INTEGER' if pyarrow.types.is_integer(field.type)
+                else 'REAL' if pyarrow.types.is_floating(field.type)
+                else 'BLOB' if pyarrow.types.is_binary(field.type) else 'TEXT'
+                for field in schema]
+
+    @staticmethod
+    def infer_schema(table):
+        # Tables read from typed files already know their column types
+        if table.column_types is not None:
+            return table.column_names, table.column_types
+
+        column_data_types = {'int': 'INTEGER', 'str': 'TEXT', 'float': 'REAL', 'bytes': 'BLOB',
+                             'memoryview': 'BLOB'}  # Map data types
+
+        column_types = []
+        for position in range(len(table.column_names)):
+            # NULLs don't say anything about the type. Integers mixed with floats widen to REAL,
+            # and anything mixed with something else widens to TEXT.
+            value_types = {column_data_types.get(type(record[position]).__name__, 'TEXT')
+                           for record in table.records if record[position] is not None}
+            if value_types == {'INTEGER'}:
+                column_types.append('INTEGER')
+            elif value_types and value_types <= {'INTEGER', 'REAL'}:
+                column_types.append('REAL')
+            elif value_types == {'BLOB'}:
+                column_types.append('BLOB')
+            else:
+                column_types.append('TEXT')
+
+        return table.column_names, column_types
+
+    @staticmethod
+    def read_rows_from_file(path):
+        # Returns the partition as a Table. JSON and Parquet files come from the rows engine,
+        # CSV files from the COPY engine.
+        if path.endswith('.parquet'):
+            pyarrow, parquet = import_pyarrow()
+            with open_partition(path) as file:
+                table = parquet.read_table(file)
+            return Table(table.column_names, list(zip(*(column.to_pylist() for column in table.columns))),
+                         DataSaver.parquet_column_types(pyarrow, table.schema))
+
+        if not path.endswith('.csv'):
+            # The objects are read as (key, value) pairs, so no dict is built per row.
+            # Only the partitions with binary values have their objects checked for them.
+            with open_partition(path) as file:
+                content = file.read()
+            object_hook = DataSaver.decode_json_object if f'"{json_binary_key}"'.encode() in content else tuple
+            rows = json.loads(content, object_pairs_hook=object_hook)
+
+            # Every column found in any row, in the order they first appear
+            column_names = list(dict.fromkeys(key for row in rows for key, _ in row))
+            positions = {column_name: position for position, column_name in enumerate(column_names)}
+            records = []
+            for row in rows:
+                record = [None] * len(column_names)
+                for key, value in row:
+                    record[positions[key]] = value
+                records.append(tuple(record))
+            return Table(column_names, records)
+
+        records = []
+        with io.TextIOWrapper(open_partition(path), encoding='utf-8', newline='') as file:
+            csv_reader = csv.reader(file)
+
+            # The header holds the column names and their types, like "order_id:int"
+            columns = [column.split(':') for column in next(csv_reader)]
+            column_names = [column[0] for column in columns]
+            parsers = [copy_value_parsers.get(column[1], str) for column in columns]
 
-                db_cursor.execute(insert_sql, list(row.values()))
+            for row in csv_reader:
+                records.append(tuple(None if value == copy_null_value else parser(value)
+                                     for parser, value in zip(parsers, row)))
 
-        # Commit changes
-        connection.commit()
+        return Table(column_names, records)
 
     def load_saved_data_to_memory(self, date=""):
+        # Finds the partitions of a date through the manifest. Without a date, the latest date is used.
         try:
-            # This returns the ['csv', 'postgres']
-            for db_folder in os.listdir('./data'):
-                # This returns the date folder from csv or tables folders from
-                for date_folder_or_table_folder in os.listdir(os.path.join('./data/', db_folder)):
-                    # If this is true, the next loop will return the json from csv or false, will return the table names dir
-                    if bool(re.search(r'\d', date_folder_or_table_folder)):
-                        self.current_working_date = date_folder_or_table_folder
-                        if date != "" and date == date_folder_or_table_folder:
-                            for day_folder in os.listdir(
-                                    os.path.join('./data/', db_folder, date_folder_or_table_folder)):
-                                self.local_data.append(
-                                    os.path.join('./data/', db_folder, date_folder_or_table_folder, day_folder))
-                        for day_folder in os.listdir(os.path.join('./data/', db_folder, date_folder_or_table_folder)):
-
-                            if date == "":
-                                self.local_data.append(
-                                    os.path.join('./data/', db_folder, date_folder_or_table_folder, day_folder))
+            self.local_data = []
 
-                    else:
-                        for day in os.listdir('./data/' + db_folder + '/' + date_folder_or_table_folder):
-
-                            self.current_working_date = day
-                            if date != "" and date == day:
-                                for day_folder in os.listdir(
-                                        os.path.join('./data/', db_folder, date_folder_or_table_folder, day)):
-                                    self.local_data.append(
-                                        os.path.join('./data/', db_folder, date_folder_or_table_folder, day,
-                                                     day_folder))
-                            for day_folder in os.listdir(
-                                    os.path.join('./data/', db_folder, date_folder_or_table_folder, day)):
-
-                                if date == "":
-                                    self.local_data.append(
-                                        os.path.join('./data/', db_folder, date_folder_or_table_folder, day,
-                                                     day_folder))
+            if self.manifest.is_empty():
+                # Data written before the manifest existed is indexed once, so later lookups are queries
+                self.manifest.index_data_folder('./data')
+
+            if date == "":
+                date = self.manifest.latest_date() or ""
+
+            self.local_data = [partition['path'] for partition in self.manifest.find(date)]
+            if self.local_data:
+                self.current_working_date = date
 
             return True, self.local_data
         except Exception as e:
@@ -203,73 +998,225 @@ class DataSaver:
             return False, None
 
     def write_data_to_file(self, category, data, table_name=""):
-        try:
-            # Create the directory structure if it doesn't exist
-            now = datetime.datetime.now()
-            formatted_date = now.strftime("%Y-%m-%d")
-            table_dir = os.path.join("./data", category, table_name, formatted_date)
-            os.makedirs(table_dir, exist_ok=True)
-
-            # Construct the file path
-            file_path = os.path.join(table_dir, table_name + ".json")  # Customize the format
-            if category == "csv":
-                file_path = os.path.join(table_dir, "order_details.json")
-
-            # Convert datetime.date objects to formatted strings
-            formatted_data = data
-            if table_name != '':
-                formatted_data = []
-                for row in data:
-                    formatted_row = {}
-                    for inner_data in row:
-                        row_value = row[inner_data]
-
-                        if isinstance(row_value, datetime.date):
-                            formatted_row[inner_data] = row_value.strftime("%Y-%m-%d")
-                        elif '<memory' in str(row_value):  # Handle binary data
-                            formatted_row[
-                                inner_data] = "No valid image" if row_value.tobytes() == b'' else row_value.tobytes()
-                        else:
-                            formatted_row[inner_data] = row_value
+        return self.write_rows_to_file(category, [data], table_name=table_name)
 
-                    formatted_data.append(formatted_row)
+    def write_rows_to_file(self, category, batches, table_name=""):
+        # Same as write_data_to_file, but takes an iterable of row batches (Tables or ColumnChunks)
+        # so a table never has to be fully loaded in memory to be written.
+        try:
+            with self.metrics.measure('write', table_name or 'order_details') as measurement:
+                if self.landing_format == "parquet":
+                    file_path, row_count = self.write_rows_to_parquet(category, batches, table_name)
+                    self.commit_partition(category, file_path, row_count)
+                    measurement['rows'], measurement['bytes'] = row_count, os.path.getsize(file_path)
+                    return True
 
-            # Save data as JSON
-            with open(file_path, "w") as json_file:
-                json.dump(formatted_data, json_file, indent=4)
-            return True
+                file_path = self.partition_path(category, table_name)
+
+                # Save data as JSON, one row at a time. The output is the same as json.dump(data, indent=4)
+                row_count = 0
+                with open(file_path + ".tmp", "w") as json_file:
+                    json_file.write("[")
+                    separator = "\n    "
+                    for batch in batches:
+                        # Rows come as tuples (from a Table or a ColumnChunk), so the keys are encoded once per batch,
+                        # and so is the way to encode the values of each column. Tables read back from JSON
+                        # partitions have their types inferred, as they can hold binary values too.
+                        key_prefixes = [json.dumps(column_name) + ": " for column_name in batch.column_names]
+                        _, column_types = self.infer_schema(batch)
+                        value_encoders = [self.encode_binary if column_type == 'BLOB' else json.dumps
+                                          for column_type in column_types]
+                        for row in batch.rows():
+                            json_file.write(separator + "{\n        " + ",\n        ".join(
+                                key_prefix + encode(value) for key_prefix, encode, value in zip(key_prefixes,
+                                                                                                value_encoders, row)
+                            ) + "\n    }")
+                            separator = ",\n    "
+                        row_count += len(batch)
+                    json_file.write("]" if separator == "\n    " else "\n]")
+
+                self.commit_partition(category, file_path, row_count)
+                measurement['rows'], measurement['bytes'] = row_count, os.path.getsize(file_path)
+                return True
         except Exception as e:
             logging.error(e)
             return False
 
-    def write_datas_to_disk(self):
+    @staticmethod
+    def encode_binary(value):
+        # Binary values go to JSON as their length and their base64, straight from the buffer psycopg2 returned
+        if value is None:
+            return "null"
+        return f'{{"{json_binary_key}": "{len(value)}:{base64.b64encode(value).decode("ascii")}"}}'
+
+    @staticmethod
+    def decode_json_object(pairs):
+        # Objects of a JSON partition are rows, except the binary values written by encode_binary
+        if len(pairs) == 1 and pairs[0][0] == json_binary_key:
+            return DataSaver.decode_binary(pairs[0][1])
+        return tuple(pairs)
+
+    @staticmethod
+    def decode_binary(value):
+        length, separator, encoded = value.partition(':')
+        decoded = base64.b64decode(encoded, validate=True)
+        if not separator or not length.isdigit() or len(decoded) != int(length):
+            raise ValueError(f"Invalid binary value in a JSON partition: expected {length} bytes, got {len(decoded)}")
+        return decoded
+
+    def write_rows_to_parquet(self, category, batches, table_name=""):
+        # Every batch becomes a row group of typed columns. The column schema and the row count
+        # are kept in the footer of the file.
+        pyarrow, parquet = import_pyarrow()
+        arrow_types = {'INTEGER': pyarrow.int64(), 'REAL': pyarrow.float64(), 'TEXT': pyarrow.string(),
+                       'BLOB': pyarrow.binary()}
+        # Binary values are handed to Arrow as the buffers they are
+        value_converters = {'INTEGER': int, 'REAL': float, 'TEXT': str, 'BLOB': lambda value: value}
+
+        file_path = self.partition_path(category, table_name, extension="parquet")
+        writer = None
+        row_count = 0
+        try:
+            for batch in batches:
+                if isinstance(batch, ColumnChunk):
+                    # The typed arrays are handed to Arrow as they are, without a copy
+                    if len(batch) == 0:
+                        continue
+                    row_count += len(batch)
+
+                    if writer is None:
+                        column_names = batch.column_names
+                        column_types = batch.column_types
+                        schema = pyarrow.schema([(column_name, arrow_types[column_type])
+                                                 for column_name, column_type in zip(column_names, column_types)])
+                        writer = parquet.ParquetWriter(file_path + ".tmp", schema)
+
+                    columns = [pyarrow.Array.from_buffers(arrow_types[column_type], len(column),
+                                                          [None, pyarrow.py_buffer(column)])
+                               for column, column_type in zip(batch.columns, column_types)]
+                    writer.write_table(pyarrow.Table.from_arrays(columns, schema=schema))
+                    continue
+
+                if len(batch) == 0:
+                    continue
+                row_count += len(batch)
+
+                if writer is None:
+                    # The schema comes from the first batch, later batches are converted to it
+                    column_names, column_types = self.infer_schema(batch)
+                    schema = pyarrow.schema([(column_name, arrow_types[column_type])
+                                             for column_name, column_type in zip(column_names, column_types)])
+                    writer = parquet.ParquetWriter(file_path + ".tmp", schema)
+
+                batch_positions = {column_name: position for position, column_name in enumerate(batch.column_names)}
+                columns = []
+                for column_name, column_type in zip(column_names, column_types):
+                    converter = value_converters[column_type]
+                    position = batch_positions.get(column_name)
+                    columns.append(pyarrow.array([None if position is None or record[position] is None
+                                                  else converter(record[position]) for record in batch.records],
+                                                 type=arrow_types[column_type]))
+                writer.write_table(pyarrow.Table.from_arrays(columns, schema=schema))
+
+            if writer is None:
+                # A table without rows still gets its (empty) partition
+                parquet.write_table(pyarrow.table({}), file_path + ".tmp")
+        finally:
+            if writer is not None:
+                writer.close()
+
+        return file_path, row_count
+
+    @staticmethod
+    def partition_file(category, table_name="", extension="json", date=""):
+        # Path of a partition file, without touching the disk
+        formatted_date = date
+        if date == "":
+            now = datetime.datetime.now()
+            formatted_date = now.strftime("%Y-%m-%d")
+
+        file_name = "order_details" if category == "csv" else table_name  # Customize the format
+        return os.path.join("./data", category, table_name, formatted_date, f"{file_name}.{extension}")
+
+    @staticmethod
+    def partition_path(category, table_name="", extension="json"):
+        # Writers write to this path plus ".tmp", and commit_partition renames it once it is complete
+        file_path = DataSaver.partition_file(category, table_name, extension)
+
+        # Create the directory structure if it doesn't exist
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        return file_path
+
+    def commit_partition(self, category, file_path, row_count=None, checksum=None):
+        # The rename is atomic, so a partition is either complete or not there. It also replaces a hard link to
+        # an older partition without touching that partition.
+        os.replace(file_path + ".tmp", file_path)
+
+        # A partition holds a single file, so drop the one another engine may have written today
+        table_dir, file_name = os.path.split(file_path)
+        for existing_file in os.listdir(table_dir):
+            if existing_file.split('.')[0] == file_name.split('.')[0] and existing_file != file_name:
+                os.remove(os.path.join(table_dir, existing_file))
+
+        self.manifest.record(category, file_path, row_count, checksum)
+        self.checkpoints.mark_done(os.path.basename(table_dir), 'partition',
+                                   f"{category}/{file_name.split('.')[0]}")
+
+    def partition_is_checkpointed(self, category, table_name="order_details"):
+        # True when an interrupted run for today already wrote this partition
+        now = datetime.datetime.now()
+        return self.checkpoints.is_done(now.strftime("%Y-%m-%d"), 'partition', f"{category}/{table_name}")
+
+    def write_db_data_to_disk(self):
         try:
-            csv_result = self.write_data_to_file("csv", self.csv_data)
-            for key, value in self.db_data.items():
-                self.write_data_to_file("postgres", value, table_name=key)
             db_result = True
+            for key, value in self.db_data.items():
+                db_result = self.write_data_to_file("postgres", value, table_name=key) and db_result
+
+            # Every partition is on disk now, so the fingerprints taken in step 1.1 can be kept
+            if self.incremental_extraction and db_result:
+                self.extraction_state.save()
+            return db_result
         except Exception as e:
             logging.error(e)
-            db_result = False
-            csv_result = False
+            return False
 
-        if db_result and csv_result:
+    def write_csv_data_to_disk(self):
+        # Step 1.1.2 writes the CSV while reading it, like the stream mode does for the Postgres tables
+        if self.partition_is_checkpointed("csv") or self.csv_streamed:
             return True
-        else:
-            return False
 
-    def extract_data_from_sources(self):
+        logging.warning("The CSV wasn't written to disk by step 1.1.2.")
+        return False
+
+    def extract_db_data(self):
         # Gets the db data
-        result_db, self.db_data = self.db.fetch_and_save_all_data()
+        if self.extraction_workers > 1:
+            result_db, self.db_data = self.db.parallel_fetch_and_save_all_data(
+                self.extraction_workers, self.extraction_mode, self.extraction_batch_size)
+        elif self.extraction_mode == "stream":
+            # Each batch goes straight to disk, so nothing is kept in self.db_data
+            result_db, self.streamed_tables = self.db.stream_and_save_all_data(self.extraction_batch_size)
+        else:
+            result_db, self.db_data = self.db.fetch_and_save_all_data()
 
-        # Gets the csv data
-        self.csv_data = self.csv.save_csv_data()
+        return bool(result_db)
 
-        if self.csv_data and result_db:
+    def extract_csv_data(self):
+        # Gets the csv data
+        if self.partition_is_checkpointed("csv"):
+            logging.info("The CSV was already written by an interrupted run, skipping it.")
             return True
-        else:
+
+        try:
+            with self.metrics.measure('extract', 'order_details') as measurement:
+                self.csv_streamed, measurement['rows'] = self.csv.save_csv_data()
+        except Exception as e:
+            logging.error(e)
             return False
 
+        return self.csv_streamed
+
     # Utility to find steps
     def find_step(self, number):
         for step in self.steps:
@@ -278,33 +1225,18 @@ class DataSaver:
         return None
 
     def run_step(self, step):
-        # This runs the function saved in the step.
-        function_result = step['function']()
-
-        # Results text depends from the function_result
-        result = f'Step {step["step"]} was finished Successfully' if function_result else f'Step {step["step"]} had a error.'
-        logging.info(f"\nStep: {step['step']}/{self.steps[-1]['step']}\n"
-                     f" Name: {step['name']}\n"
-                     f"  Description: {step['description']}\n\n"
-                     f" Result: {result}\n")
-
-        # If step contain additional steps, do them
-        if len(step['additional_steps']) > 0:
-            for additional_step in step['additional_steps']:
-                function_result = additional_step['function']()
-                result = f'Additional step {additional_step["step"]} was finished Successfully' if function_result else f'Additional step {additional_step["step"]} had a error.'
-                logging.info(f"\n  Additional step: {additional_step['step']}/{step['additional_steps'][-1]['step']}\n"
-                             f"   Name: {additional_step['name']}\n"
-                             f"    Description: {additional_step['description']}\n\n"
-                             f"   Result: {result}\n")
+        # Runs the step and every step nested in it (like 1.1.1 and 1.2.2 for step 1), following their dependencies
+        return self.scheduler.run([nested_step['step'] for nested_step in self.steps
+                                   if nested_step['step'] == step['step']
+                                   or nested_step['step'].startswith(step['step'] + '.')])
 
     def run_steps_sequentially(self):
         initial_time = time.time()
-        for step in self.steps:
-            self.run_step(step)
+        results = self.scheduler.run()
         end_time = time.time()
         formatted_time = format(end_time - initial_time, ".2f")
         logging.info(f"Time elapsed executing steps: {formatted_time} seconds")
+        return all(results.values())
 
     def run_individual_step(self, step_number=None):
         self.current_working_date = ""
@@ -314,80 +1246,283 @@ class DataSaver:
         else:
             step_choice = int(step_number)
 
+        # Returns True when every step run succeeded
         step = self.find_step(step_choice)
         if step_choice == 1 and step is not None:
-            self.run_step(step)
+            return all(self.run_step(step).values())
         elif step_choice == 2 and step is not None:
-            if self.db_data and self.csv_data:
-                self.run_step(step)
+            if (self.db_data or self.streamed_tables) and self.csv_streamed:
+                return all(self.run_step(step).values())
             else:
                 logging.warning("Step 1 needs to be completed first. The data it builds is empty.")
         elif step_choice == 3 and step is not None:
-            self.run_step(step)
+            return all(self.run_step(step).values())
         else:
             logging.warning("Invalid step choice.")
-
-    def retrieve_data_from_complete_db(self, table_name):
-        try:
-            if not os.path.exists(f'./merged_databases/merged_database_date-{self.current_working_date}.db'):
-                raise Exception("Date don't match with database.")
-            # Connect to the combined SQLite database
-            db_connection = sqlite3.connect(f'./merged_databases/merged_database_date-{self.current_working_date}.db')
-            cursor = db_connection.cursor()
-
-            # Execute the query to retrieve all data from the "orders" table
-            query = f"SELECT * FROM {table_name};"
-            cursor.execute(query)
-            result = cursor.fetchall()
-
-            # Get the column names
-            column_names = [desc[0] for desc in cursor.description]
-
-            formatted_rows = []
-            for row in result:
-                formatted_row = {}
-                for i, value in enumerate(row):
-                    if isinstance(value, datetime.date):
-                        formatted_row[column_names[i]] = value.strftime("%Y-%m-%d")
-                    else:
-                        formatted_row[column_names[i]] = value
-                formatted_rows.append(formatted_row)
-
-            # Close the cursor and connection
-            cursor.close()
-            db_connection.close()
-
-            return True, formatted_rows
-        except Exception as e:
-            logging.error(e)
-            return False, None
+        return False
 
     def reprocess_data(self, date):
         result, data = self.find_step(2)['function'](date=date)
         if result and len(data) > 0:
-            self.create_new_database(date)
+            return self.create_new_database(date)
         else:
             logging.info(f"Date {date} wasn't found in the data folders. Maybe wrong date?")
+            return False
 
-    def query_orders(self, date=None):
+    def backfill(self, start_date, end_date, workers=backfill_workers):
+        # Rebuilds the merged database of every date between start_date and end_date (both included).
+        # Dates whose partitions didn't change since their database was built are skipped.
+        try:
+            first_day = datetime.date.fromisoformat(start_date)
+            last_day = datetime.date.fromisoformat(end_date)
+        except ValueError as e:
+            logging.error(e)
+            return False
+        if first_day > last_day:
+            logging.error(f"Backfill start date {start_date} is after its end date {end_date}.")
+            return False
 
-        def find_order_all_details(order, details):
+        # Without partitions every date is reported as missing, and the backfill fails
+        indexed = True
+        try:
+            if self.manifest.is_empty():
+                self.manifest.index_data_folder('./data')
+        except Exception as e:
+            logging.error(e)
+            indexed = False
+
+        dates_to_build = []
+        report = {}
+        for offset in range((last_day - first_day).days + 1):
+            date = (first_day + datetime.timedelta(days=offset)).strftime("%Y-%m-%d")
+            checksums = {partition['path']: partition['checksum'] for partition in self.manifest.find(date)} \
+                if indexed else {}
+            if not checksums:
+                report[date] = ("missing", 0.0)
+            elif self.storage_mode == "warehouse":
+                build_key = self.warehouse.build_key(date)
+                if build_key is not None and build_key[0] == loader_version and build_key[1].get(date) == checksums:
+                    report[date] = ("unchanged", 0.0)
+                else:
+                    dates_to_build.append(date)
+            elif self.read_build_key(f'./merged_databases/merged_database_date-{date}.db') == (loader_version,
+                                                                                               checksums):
+                report[date] = ("unchanged", 0.0)
+            else:
+                dates_to_build.append(date)
+
+        # The settings the workers build the databases with, like the ones given on the command line
+        settings = {'loader_workers': self.loader_workers, 'storage_mode': self.storage_mode}
+        started_at = time.perf_counter()
+        if self.storage_mode == "warehouse":
+            # The dates are applied to the warehouse one at a time, in order
+            for date in dates_to_build:
+                date_started_at = time.perf_counter()
+                succeeded = self.load_saved_data_to_memory(date)[0] and self.create_new_database(date)
+                report[date] = ("built" if succeeded else "failed", time.perf_counter() - date_started_at)
+                logging.info(f"Backfill of {date} {report[date][0]} in {report[date][1]:.2f} seconds.")
+        else:
+            with spawn_process_pool(max(1, min(workers, len(dates_to_build) or 1))) as executor:
+                futures = {executor.submit(build_database_for_date, date, settings,
+                                           self.metrics.trace_memory): date for date in dates_to_build}
+                for future in as_completed(futures):
+                    date = futures[future]
+                    try:
+                        succeeded, elapsed, measurements = future.result()
+                        self.metrics.add(measurements)
+                    except Exception as e:
+                        logging.error(e)
+                        succeeded, elapsed = False, 0.0
+
+                    report[date] = ("built" if succeeded else "failed", elapsed)
+                    logging.info(f"Backfill of {date} {report[date][0]} in {elapsed:.2f} seconds.")
+
+        logging.info(f"Backfill of {len(report)} dates finished in {time.perf_counter() - started_at:.2f} seconds:\n" +
+                     "\n".join(f"  {date}: {status} ({elapsed:.2f}s)"
+                                for date, (status, elapsed) in sorted(report.items())))
+        self.metrics.save()
+        return indexed and all(status != "failed" for status, _ in report.values())
+
+    def compact_data(self, retention_days=data_retention_days, period=archive_period):
+        # Moves the partitions older than retention_days into one zip archive per week or month of archive_folder.
+        # The manifest keeps their paths, so step 2 reads them from the archive for any date.
+        try:
+            if self.manifest.is_empty():
+                self.manifest.index_data_folder('./data')
+
+            cutoff = (datetime.date.today() - datetime.timedelta(days=retention_days)).isoformat()
+            archives = {}
+            for partition in self.manifest.find_before(cutoff):
+                if partition['archive'] is not None:
+                    # Left behind by a compaction interrupted after writing its archive
+                    if os.path.exists(partition['path']):
+                        self.remove_partition_file(partition['path'])
+                elif not os.path.exists(partition['path']):
+                    logging.warning(f"Partition {partition['path']} wasn't found, it can't be archived.")
+                else:
+                    if period == "week":
+                        year, week, _ = datetime.date.fromisoformat(partition['date']).isocalendar()
+                        archive_name = f"{year}-W{week:02d}"
+                    else:
+                        archive_name = partition['date'][:7]
+                    archive_path = os.path.join(archive_folder, f"{archive_name}.zip")
+                    archives.setdefault(archive_path, []).append(partition)
+
+            for archive_path, partitions in sorted(archives.items()):
+                with self.metrics.measure('compact', os.path.basename(archive_path)) as measurement:
+                    measurement['rows'] = len(partitions)
+                    stored = self.write_archive(archive_path, partitions)
+                    self.manifest.record_archived(archive_path, partitions)
+                    for partition in partitions:
+                        self.remove_partition_file(partition['path'])
+                    measurement['bytes'] = os.path.getsize(archive_path)
+
+                logging.info(f"Archived {len(partitions)} partitions in {archive_path} "
+                             f"({stored} new files, the others were already there).")
+
+            logging.info(f"Compaction finished, partitions before {cutoff} are archived.")
+            return True
+        except Exception as e:
+            logging.error(e)
+            return False
+        finally:
+            self.metrics.save()
+
+    @staticmethod
+    def write_archive(archive_path, partitions):
+        # Adds the partitions to an archive, storing the content of each checksum once, and their manifest rows
+        # as the next index/<number>.json. The archive is written to a temporary copy that replaces it once complete.
+        # Returns the number of files added.
+        os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+        if os.path.exists(archive_path):
+            shutil.copyfile(archive_path, archive_path + ".tmp")
+        elif os.path.exists(archive_path + ".tmp"):
+            os.remove(archive_path + ".tmp")
+
+        stored = 0
+        with zipfile.ZipFile(archive_path + ".tmp", "a", compression=zipfile.ZIP_DEFLATED) as archive:
+            members = set(archive.namelist())
+            for partition in partitions:
+                member = PartitionManifest.archive_member(partition)
+                if member not in members:
+                    archive.write(partition['path'], member)
+                    members.add(member)
+                    stored += 1
+
+            index_number = sum(1 for member in members if member.startswith('index/'))
+            archive.writestr(f"index/{index_number:06d}.json",
+                             json.dumps([{key: value for key, value in partition.items() if key != 'archive'}
+                                         for partition in partitions]))
+
+        os.replace(archive_path + ".tmp", archive_path)
+        return stored
+
+    @staticmethod
+    def remove_partition_file(path):
+        os.remove(path)
+        # The date folder goes away with its last partition
+        date_folder = os.path.dirname(path)
+        if not os.listdir(date_folder):
+            os.rmdir(date_folder)
+
+    @staticmethod
+    def iter_merged_orders(orders, details, products):
+        # The keys are read by position in the rows of the Tables, and the dicts are only built for the output,
+        # one order at a time.
+        order_id = orders.column_names.index('order_id')
+        detail_order_id = details.column_names.index('order_id')
+        detail_product_id = details.column_names.index('product_id')
+        product_id = products.column_names.index('product_id')
+
+        # Hash join: the details are indexed by order_id and the products by product_id,
+        # so every row is visited once instead of once per order.
+        details_by_order = {}
+        for order_detail in details.records:
+            details_by_order.setdefault(order_detail[detail_order_id], []).append(order_detail)
+
+        products_by_id = {product[product_id]: product for product in products.records}
+
+        # One order at a time, so the output can be streamed
+        for order in orders.records:
             order_details = []
-            for order_detail in details:
-                if order_detail['order_id'] == order['order_id']:
-                    order_details.append(order_detail)
-            return order_details
-
-        def find_products(details, products):
-            found_products = []
-            for order_detail in details:
-                for product in products:
-                    if product['product_id'] == order_detail['product_id']:
-                        found_products.append(product)
-
-            return found_products
+            for order_detail in details_by_order.get(order[order_id], []):
+                merged_detail = dict(zip(details.column_names, order_detail))
+
+                # This merges the products bought in the order details too.
+                product_bought = products_by_id.get(order_detail[detail_product_id])
+                if product_bought is not None:
+                    merged_detail['product_bought'] = dict(zip(products.column_names, product_bought))
+                order_details.append(merged_detail)
+
+            yield {
+                'order': dict(zip(orders.column_names, order)),
+                'details': order_details
+            }
 
-        if self.current_working_date == "" or date is not None:
+    @staticmethod
+    def open_query_output(path, compression=None):
+        if compression == "gzip":
+            return gzip.open(path + query_output_suffixes['gzip'], "wt", encoding="utf-8")
+        if compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise Exception("zstd compression needs the zstandard package: pip install zstandard")
+            return zstandard.open(path + query_output_suffixes['zstd'], "wt", encoding="utf-8")
+        return open(path, "w")
+
+    def find_orders(self, date, customer_id=None, order_date_from=None, order_date_to=None, shipped_date_from=None,
+                    shipped_date_to=None, page=None, page_size=query_page_size):
+        # Merged orders of a date, ordered by order_id. The filters (dates are YYYY-MM-DD, both ends included)
+        # and the page (starting at 1) are applied by SQLite through the indexes of the merged database,
+        # so only the orders asked for, their details and their products are read.
+        database_path, as_of = self.merged_tables(date, ['orders', 'order_details', 'products'])
+        columns = {table_name: ", ".join(self.reader.columns(database_path, table_name))
+                   for table_name in ('orders', 'order_details', 'products')}
+
+        conditions = []
+        parameters = []
+        for condition, value in (("customer_id = ?", customer_id),
+                                 ("order_date >= ?", order_date_from), ("order_date <= ?", order_date_to),
+                                 ("shipped_date >= ?", shipped_date_from), ("shipped_date <= ?", shipped_date_to)):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+
+        orders_query = f"SELECT {columns['orders']} FROM orders"
+        if conditions:
+            orders_query += " WHERE " + " AND ".join(conditions)
+        orders_query += " ORDER BY order_id"
+        if page is not None:
+            if page < 1 or page_size < 1:
+                raise ValueError("The page and the page size start at 1.")
+            orders_query += " LIMIT ? OFFSET ?"
+            parameters += [page_size, (page - 1) * page_size]
+
+        # Only the details and the products are indexed by the join, the orders are streamed through it
+        orders = self.reader.stream(database_path, as_of + orders_query, parameters)
+        if not conditions and page is None:
+            # The details keep the order they were loaded in
+            details = self.reader.fetch(database_path, f"{as_of}SELECT {columns['order_details']} FROM order_details "
+                                                       f"ORDER BY rowid")
+            products = self.reader.fetch(database_path, f"{as_of}SELECT {columns['products']} FROM products")
+        else:
+            selected_order_ids = f"SELECT order_id FROM ({orders_query})"
+            details = self.reader.fetch(database_path, f"{as_of}SELECT {columns['order_details']} FROM order_details "
+                                                       f"WHERE order_id IN ({selected_order_ids}) ORDER BY rowid",
+                                        parameters)
+            products = self.reader.fetch(database_path, f"{as_of}SELECT {columns['products']} FROM products "
+                                                        f"WHERE product_id IN (SELECT product_id FROM order_details "
+                                                        f"WHERE order_id IN ({selected_order_ids}))", parameters)
+
+        return self.iter_merged_orders(orders, details, products)
+
+    def query_orders(self, date=None, **filters):
+        # Without a date, the date step 2 loaded is used, and otherwise it is asked for.
+        # The filters are the ones of find_orders.
+        if date is not None:
+            date_input = date
+        elif self.current_working_date == "":
             date_input = input("Enter a date (YYYY-MM-DD) to load the correct database to query orders: ")
         else:
             date_input = self.current_working_date
@@ -407,43 +1542,47 @@ class DataSaver:
                 self.current_working_date = date_input
 
                 try:
-
-                    # Initialize the data
-                    _, orders = self.retrieve_data_from_complete_db('orders')
-                    _, details = self.retrieve_data_from_complete_db('order_details')
-                    _, products = self.retrieve_data_from_complete_db('products')
-
-                    merged_data = []
-
-                    if orders is None or details is None or products is None:
-                        logging.warning("No data returned from database. Can't proceed.")
-                        return False
-
-                    # Now here we are merging those three into one big dict.
-                    for order in orders:
-                        order_details = find_order_all_details(order, details)
-                        products_bought = find_products(order_details, products)
-
-                        # This merges the products bought in the order details too.
-                        for order_detail in order_details:
-                            for product_bought in products_bought:
-                                if order_detail['product_id'] == product_bought['product_id']:
-                                    order_detail['product_bought'] = product_bought
-
-                        formatted_order = {
-                            'order': order,
-                            'details': order_details
-                        }
-                        merged_data.append(formatted_order)
+                    # The same query on the same build of the database has the same output
+                    database_id = self.database_id(date_input)
+                    cache_key = self.query_cache.key(database_id, date_input, filters, self.query_output_format,
+                                                     self.query_output_compression)
+                    cached_output_path = self.query_cache.find(cache_key)
+                    if cached_output_path is not None:
+                        logging.info(f"Query already saved in {cached_output_path}, reusing it.")
+                        return True
+
+                    # Now here we are merging the orders, their details and products, one order at a time.
+                    with self.metrics.measure('query', 'fetch'):
+                        merged_orders = self.find_orders(date_input, **filters)
 
                     now = datetime.datetime.now()
                     formatted_datetime = now.strftime("%Y-%m-%d_%H-%M-%S")
                     os.makedirs('./query_output/', exist_ok=True)
                     # Save the query
-                    with open(f'./query_output/query_{date_input}_generated_at_{formatted_datetime}.json',
-                              "w") as json_file:
-                        json.dump(merged_data, json_file, indent=4)
-
+                    output_path = f'./query_output/query_{date_input}_generated_at_{formatted_datetime}'
+                    if QueryCache.parameters(filters):
+                        # Filtered queries of the same second get different files
+                        output_path += f'_{cache_key[:8]}'
+                    with self.metrics.measure('query', 'join') as measurement:
+                        measurement['rows'] = 0
+                        if self.query_output_format == "jsonl":
+                            output_path += ".jsonl"
+                            # One compact order per line, written as soon as it is merged
+                            with self.open_query_output(output_path, self.query_output_compression) as jsonl_file:
+                                for merged_order in merged_orders:
+                                    jsonl_file.write(json.dumps(merged_order, separators=(',', ':')) + "\n")
+                                    measurement['rows'] += 1
+                        else:
+                            output_path += ".json"
+                            merged_orders = list(merged_orders)
+                            measurement['rows'] = len(merged_orders)
+                            with self.open_query_output(output_path, self.query_output_compression) as json_file:
+                                json.dump(merged_orders, json_file, indent=4)
+
+                        output_path += query_output_suffixes.get(self.query_output_compression, "")
+                        measurement['bytes'] = os.path.getsize(output_path)
+                    self.query_cache.record(cache_key, date_input, database_id, output_path)
+                    self.query_cache.evict(keep_key=cache_key)
                     return True
                 except Exception as e:
                     logging.error(e)
@@ -456,40 +1595,586 @@ class CsvInput:
         self.data_saver = data_saver
 
     def save_csv_data(self):
-        self.data = self.load_csv_data(csv_file_path)
-        # self.data_saver.write_data_to_file("csv", self.data)
-        return self.data
-
-    def load_csv_data(self, path):
-        data = []
-        # Open the CSV file and read its content
-        with open(path, "r") as csv_file:
+        # Every chunk is written to disk as soon as it is read, so the CSV is never in memory as a whole.
+        # Returns whether it was written, and its number of rows.
+        self.data = 0
+
+        def counted_chunks():
+            for chunk in self.load_csv_chunks(csv_file_path):
+                self.data += len(chunk)
+                yield chunk
+
+        return self.data_saver.write_rows_to_file("csv", counted_chunks()), self.data
+
+    def load_csv_chunks(self, path, chunk_size=csv_chunk_size):
+        # Reads the CSV in blocks of chunk_size rows, each block becoming one typed array per column
+        column_names = list(csv_columns)
+        with open(path, "r", newline='') as csv_file:
             csv_reader = csv.reader(csv_file)
 
-            # Skip the header row
-            next(csv_reader)
+            # The header is checked once, instead of trusting the column positions
+            header = next(csv_reader)
+            if header != column_names:
+                raise ValueError(f"Unexpected header in {path}: {header}, expected {column_names}")
+
+            first_row = 2
+            while True:
+                rows = list(itertools.islice(csv_reader, chunk_size))
+                if not rows:
+                    break
+
+                if any(len(row) != len(column_names) for row in rows):
+                    raise ValueError(f"Rows {first_row}-{first_row + len(rows) - 1} of {path} "
+                                     f"don't have {len(column_names)} columns")
+
+                # Rows become columns, so every column of the chunk is converted and checked in a single call
+                columns = []
+                for column_name, column in zip(column_names, zip(*rows)):
+                    type_code = csv_columns[column_name]
+                    try:
+                        columns.append(array.array(type_code, map(array_value_parsers[type_code], column)))
+                    except ValueError as e:
+                        raise ValueError(f"Invalid {column_name} in rows {first_row}-{first_row + len(rows) - 1} "
+                                         f"of {path}: {e}")
+
+                yield ColumnChunk(column_names, columns)
+                first_row += len(rows)
+
+
+class ColumnChunk:
+    # A block of rows kept as one typed array per column, instead of one dict per row
+    __slots__ = ('column_names', 'columns')
+
+    def __init__(self, column_names, columns):
+        self.column_names = column_names
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    @property
+    def column_types(self):
+        return [array_column_types[column.typecode] for column in self.columns]
+
+    def rows(self):
+        return zip(*self.columns)
+
+
+class Table:
+    # Rows of a table as tuples, with a single copy of the column names and their SQLite types
+    # (None when they are inferred from the values). Rows only become dicts in the query output.
+    __slots__ = ('column_names', 'records', 'column_types')
+
+    def __init__(self, column_names, records, column_types=None):
+        self.column_names = column_names
+        self.records = records
+        self.column_types = column_types
+
+    def __len__(self):
+        return len(self.records)
+
+    def rows(self):
+        return self.records
+
+
+class PartitionManifest:
+    # Index of every partition in ./data, written by step 1.2 and read by step 2.
+    # Each partition is one row, so finding the partitions of a date is a single indexed query.
+    # Partitions moved to an archive by --compact keep their path, and have the path of the archive.
+    def __init__(self, path=os.path.join(state_folder, 'manifest.db')):
+        self.path = path
+
+    def connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        connection.execute("CREATE TABLE IF NOT EXISTS partitions ("
+                           "source TEXT NOT NULL, table_name TEXT NOT NULL, date TEXT NOT NULL, path TEXT NOT NULL, "
+                           "format TEXT NOT NULL, row_count INTEGER, byte_size INTEGER NOT NULL, checksum TEXT NOT NULL, "
+                           "archive TEXT, PRIMARY KEY (source, table_name, date))")
+        if 'archive' not in [column[1] for column in connection.execute("PRAGMA table_info(partitions)")]:
+            # Manifests written before the partitions could be archived
+            connection.execute("ALTER TABLE partitions ADD COLUMN archive TEXT")
+        connection.execute("CREATE INDEX IF NOT EXISTS partitions_by_date ON partitions (date)")
+        connection.execute("CREATE INDEX IF NOT EXISTS partitions_by_path ON partitions (path)")
+        return connection
 
-            # Iterate through each row in the CSV
-            for row in csv_reader:
-                order_id = int(row[0])
-                product_id = int(row[1])
-                unit_price = float(row[2])
-                quantity = int(row[3])
-                discount = float(row[4])
+    def record(self, source, path, row_count=None, checksum=None):
+        # The partition folders look like ./data/<source>/[<table>/]<date>/<table>.<format>
+        date = os.path.basename(os.path.dirname(path))
+        table_name, file_format = os.path.basename(path).split('.', 1)
+        if checksum is None:
+            checksum = self.checksum(path)
+
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute("INSERT OR REPLACE INTO partitions (source, table_name, date, path, format, "
+                                   "row_count, byte_size, checksum) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                   (source, table_name, date, path, file_format, row_count,
+                                    os.path.getsize(path), checksum))
+        finally:
+            connection.close()
+
+    def record_archived(self, archive_path, partitions):
+        # Records that the partitions (rows of the manifest) are now in an archive
+        connection = self.connect()
+        try:
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO partitions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                       [(partition['source'], partition['table_name'], partition['date'],
+                                         partition['path'], partition['format'], partition['row_count'],
+                                         partition['byte_size'], partition['checksum'], archive_path)
+                                        for partition in partitions])
+        finally:
+            connection.close()
+
+    def find(self, date):
+        connection = self.connect()
+        try:
+            return [dict(partition) for partition in connection.execute(
+                "SELECT * FROM partitions WHERE date = ? ORDER BY source, table_name", (date,))]
+        finally:
+            connection.close()
+
+    def find_path(self, path):
+        connection = self.connect()
+        try:
+            partition = connection.execute("SELECT * FROM partitions WHERE path = ?", (path,)).fetchone()
+            return dict(partition) if partition is not None else None
+        finally:
+            connection.close()
+
+    def find_before(self, date):
+        connection = self.connect()
+        try:
+            return [dict(partition) for partition in connection.execute(
+                "SELECT * FROM partitions WHERE date < ? ORDER BY date, source, table_name", (date,))]
+        finally:
+            connection.close()
+
+    def latest_date(self):
+        connection = self.connect()
+        try:
+            return connection.execute("SELECT max(date) FROM partitions").fetchone()[0]
+        finally:
+            connection.close()
+
+    def is_empty(self):
+        return self.latest_date() is None
+
+    def index_data_folder(self, data_folder):
+        # Walks ./data/<source>/[<table>/]<date>/ once and records every partition found.
+        # The archives go first, so a partition found in both places is read from its file.
+        archives = os.path.join(data_folder, os.path.basename(archive_folder))
+        if os.path.isdir(archives):
+            for archive_name in sorted(os.listdir(archives)):
+                if archive_name.endswith('.zip'):
+                    self.index_archive(os.path.join(archives, archive_name))
+
+        for source in os.listdir(data_folder):
+            if source == os.path.basename(archive_folder):
+                continue
+            for entry in os.listdir(os.path.join(data_folder, source)):
+                if re.fullmatch(r'\d{4}-\d{2}-\d{2}', entry):
+                    date_folders = [os.path.join(data_folder, source, entry)]
+                else:
+                    date_folders = [os.path.join(data_folder, source, entry, date)
+                                    for date in os.listdir(os.path.join(data_folder, source, entry))]
+
+                for date_folder in date_folders:
+                    for file_name in os.listdir(date_folder):
+                        if not file_name.endswith('.tmp'):
+                            self.record(source, os.path.join(date_folder, file_name))
+
+    def index_archive(self, archive_path):
+        # Every compaction adds the rows of the manifest it archived to the archive, in index/<number>.json
+        with zipfile.ZipFile(archive_path) as archive:
+            for member in archive.namelist():
+                if member.startswith('index/'):
+                    self.record_archived(archive_path, json.loads(archive.read(member)))
+
+    @staticmethod
+    def archive_member(partition):
+        # Archived partitions are stored once per checksum
+        return f"{partition['checksum']}.{partition['format']}"
+
+    @staticmethod
+    def checksum(path):
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+
+class CheckpointStore:
+    # Steps and partitions completed by a run. If the run is interrupted, the next one for the same date
+    # skips them. They are cleared once a run finishes.
+    def __init__(self, path=os.path.join(state_folder, 'checkpoints.db')):
+        self.path = path
+
+    def connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("CREATE TABLE IF NOT EXISTS checkpoints ("
+                           "date TEXT NOT NULL, kind TEXT NOT NULL, name TEXT NOT NULL, completed_at TEXT NOT NULL, "
+                           "PRIMARY KEY (date, kind, name))")
+        return connection
+
+    def is_done(self, date, kind, name):
+        connection = self.connect()
+        try:
+            return connection.execute("SELECT 1 FROM checkpoints WHERE date = ? AND kind = ? AND name = ?",
+                                      (date, kind, name)).fetchone() is not None
+        finally:
+            connection.close()
+
+    def mark_done(self, date, kind, name):
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?)",
+                                   (date, kind, name, datetime.datetime.now().isoformat()))
+        finally:
+            connection.close()
+
+    def clear(self, date, steps, partition_categories):
+        # Clears the checkpoints of some steps of a date, and of its partitions of some categories (like "csv")
+        connection = self.connect()
+        try:
+            with connection:
+                connection.executemany("DELETE FROM checkpoints WHERE date = ? AND kind = 'step' AND name = ?",
+                                       [(date, step) for step in steps])
+                connection.executemany("DELETE FROM checkpoints WHERE date = ? AND kind = 'partition' "
+                                       "AND name LIKE ? || '/%'",
+                                       [(date, category) for category in partition_categories])
+        finally:
+            connection.close()
+
+
+class ExtractionState:
+    # Fingerprint of every Postgres table as of its last extraction, used by the incremental extraction
+    def __init__(self, path=os.path.join(state_folder, 'extraction_state.json')):
+        self.path = path
+        self.tables = {}
+        if os.path.exists(path):
+            with open(path, 'r') as state_file:
+                self.tables = json.load(state_file)
+
+    def get(self, table_name):
+        return self.tables.get(table_name)
+
+    def set(self, table_name, table_state):
+        self.tables[table_name] = table_state
+
+    def save(self):
+        # Written to a temporary file first, so a crash never leaves a half written state behind
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.tmp', 'w') as state_file:
+            json.dump(self.tables, state_file, indent=4)
+        os.replace(self.path + '.tmp', self.path)
+
+
+class QueryCache:
+    # Outputs of step 3 in ./query_output, indexed by the database they were queried from and the query parameters
+    def __init__(self, path=os.path.join(state_folder, 'query_cache.db'), max_bytes=query_cache_max_bytes,
+                 max_age_days=query_cache_max_age_days):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+
+    def connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("CREATE TABLE IF NOT EXISTS queries ("
+                           "key TEXT PRIMARY KEY, date TEXT NOT NULL, database_id TEXT NOT NULL, path TEXT NOT NULL, "
+                           "byte_size INTEGER NOT NULL, created_at REAL NOT NULL, used_at REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS queries_by_date ON queries (date)")
+        return connection
 
-                # Create a dictionary to represent the data for this row
-                data_row = {
-                    "order_id": order_id,
-                    "product_id": product_id,
-                    "unit_price": unit_price,
-                    "quantity": quantity,
-                    "discount": discount
-                }
+    @staticmethod
+    def parameters(filters):
+        # The filters that change the output. The page size only matters when a page is asked for.
+        parameters = {name: value for name, value in filters.items() if value is not None}
+        if 'page' in parameters:
+            parameters.setdefault('page_size', query_page_size)
+        else:
+            parameters.pop('page_size', None)
+        return parameters
+
+    @staticmethod
+    def key(database_id, date, filters, output_format, compression):
+        return hashlib.sha256(json.dumps([database_id, date, QueryCache.parameters(filters), output_format, compression],
+                                         sort_keys=True).encode('utf-8')).hexdigest()
 
-                # Append the data_row dictionary to the data list
-                data.append(data_row)
+    def find(self, key):
+        # Output path of a query, None if it wasn't cached or its output was deleted
+        connection = self.connect()
+        try:
+            with connection:
+                query = connection.execute("SELECT path FROM queries WHERE key = ?", (key,)).fetchone()
+                if query is None:
+                    return None
+                if not os.path.exists(query[0]):
+                    connection.execute("DELETE FROM queries WHERE key = ?", (key,))
+                    return None
+
+                connection.execute("UPDATE queries SET used_at = ? WHERE key = ?", (time.time(), key))
+                return query[0]
+        finally:
+            connection.close()
+
+    def record(self, key, date, database_id, path):
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute("INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                   (key, date, database_id, path, os.path.getsize(path), time.time(), time.time()))
+        finally:
+            connection.close()
+
+    def invalidate(self, date, keep_database_id=None):
+        # Deletes the outputs of a date that weren't queried from the database keep_database_id
+        connection = self.connect()
+        try:
+            with connection:
+                queries = connection.execute("SELECT key, path FROM queries WHERE date = ? AND database_id IS NOT ?",
+                                             (date, keep_database_id)).fetchall()
+                self.delete(connection, queries)
+            if queries:
+                logging.info(f"Deleted {len(queries)} cached queries of {date}, its database was rebuilt.")
+        finally:
+            connection.close()
+
+    def evict(self, keep_key=None):
+        # Deletes the outputs older than max_age_days, then the least recently used ones above max_bytes.
+        # The output of keep_key, usually the one just written, is kept.
+        connection = self.connect()
+        try:
+            with connection:
+                expired = connection.execute("SELECT key, path FROM queries WHERE created_at < ? AND key IS NOT ?",
+                                             (time.time() - self.max_age_days * 86400, keep_key)).fetchall()
+                self.delete(connection, expired)
+
+                total_bytes = connection.execute("SELECT coalesce(sum(byte_size), 0) FROM queries").fetchone()[0]
+                least_recently_used = []
+                for key, path, byte_size in connection.execute(
+                        "SELECT key, path, byte_size FROM queries WHERE key IS NOT ? ORDER BY used_at", (keep_key,)):
+                    if total_bytes <= self.max_bytes:
+                        break
+                    least_recently_used.append((key, path))
+                    total_bytes -= byte_size
+                self.delete(connection, least_recently_used)
+        finally:
+            connection.close()
+
+    @staticmethod
+    def delete(connection, queries):
+        for key, path in queries:
+            if os.path.exists(path):
+                os.remove(path)
+            connection.execute("DELETE FROM queries WHERE key = ?", (key,))
+
+
+class Warehouse:
+    # Single merged database for every date. Each version of a row keeps the date it appeared on (_valid_from) and the
+    # date it changed or disappeared on (_valid_to, NULL while it is current), so the tables can be read as they were
+    # on any date, and applying a date only writes the rows that changed.
+    def __init__(self, path=warehouse_path, keys=warehouse_keys):
+        self.path = path
+        self.keys = keys
+
+    def connect(self):
+        # The transactions are explicit, so a date is applied to every table or to none
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.execute(f"PRAGMA cache_size=-{loader_cache_size_kib};")
+        connection.execute("CREATE TABLE IF NOT EXISTS _applied_dates (date TEXT PRIMARY KEY, checksums TEXT NOT NULL)")
+        return connection
 
-        return data
+    @staticmethod
+    def applied_dates(connection):
+        # Checksums of the partitions of every date applied, by date
+        return {date: json.loads(checksums)
+                for date, checksums in connection.execute("SELECT date, checksums FROM _applied_dates")}
+
+    def build_key(self, date):
+        # Loader version and partition checksums of the dates applied up to a date, which is what the tables read
+        # as of that date depend on. None if no date up to it was applied.
+        if not os.path.exists(self.path):
+            return None
+
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            version = connection.execute("PRAGMA user_version;").fetchone()[0]
+            applied_dates = {applied_date: json.loads(checksums) for applied_date, checksums in connection.execute(
+                "SELECT date, checksums FROM _applied_dates WHERE date <= ?", (date,))}
+        except sqlite3.Error:
+            return None
+        finally:
+            connection.close()
+        return (version, applied_dates) if applied_dates else None
+
+    @staticmethod
+    def tables(connection):
+        return [row[0] for row in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE '\\_%' ESCAPE '\\' "
+            "AND name NOT LIKE 'sqlite%'")]
+
+    def rewind(self, connection, date):
+        # Back to the tables as they were before date: the versions from it on are deleted,
+        # and the ones closed from it on are current again
+        for table_name in self.tables(connection):
+            connection.execute(f"DELETE FROM {table_name} WHERE _valid_from >= ?", (date,))
+            connection.execute(f"UPDATE {table_name} SET _valid_to = NULL WHERE _valid_to >= ?", (date,))
+        connection.execute("DELETE FROM _applied_dates WHERE date >= ?", (date,))
+
+    def apply_table(self, connection, date, table_name, column_names, column_types, rows):
+        # Applies the snapshot of a table on a date, like an upsert on its primary key: the current rows that changed
+        # or aren't in the snapshot anymore are closed on the date, and the new or changed rows are inserted, valid
+        # from the date. The rows are compared by a hash of all their columns.
+        # Returns the number of rows in the snapshot, inserted and closed.
+        columns_sql = ", ".join(f"{column_name} {column_type}"
+                                for column_name, column_type in zip(column_names, column_types))
+        table_columns = [column[1] for column in connection.execute(f"PRAGMA table_info({table_name})")]
+        if not table_columns:
+            connection.execute(f"CREATE TABLE {table_name} ({columns_sql}, "
+                               f"_valid_from TEXT NOT NULL, _valid_to TEXT, _row_hash BLOB NOT NULL)")
+            key = self.keys.get(table_name)
+            if key and set(key) <= set(column_names):
+                connection.execute(f"CREATE UNIQUE INDEX {table_name}_current ON {table_name} ({', '.join(key)}) "
+                                   f"WHERE _valid_to IS NULL")
+            connection.execute(f"CREATE INDEX {table_name}_by_row_hash ON {table_name} (_row_hash) "
+                               f"WHERE _valid_to IS NULL")
+            connection.execute(f"CREATE INDEX {table_name}_by_valid_from ON {table_name} (_valid_from)")
+            connection.execute(f"CREATE INDEX {table_name}_by_valid_to ON {table_name} (_valid_to)")
+        else:
+            # Columns added to the source since the table was created
+            for column_name, column_type in zip(column_names, column_types):
+                if column_name not in table_columns:
+                    connection.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}")
+
+        column_list = ", ".join(column_names)
+        header = repr(column_names)
+        row_count = 0
+        connection.execute(f"CREATE TEMP TABLE _snapshot ({columns_sql}, _row_hash BLOB)")
+        try:
+            insert_sql = f"INSERT INTO temp._snapshot VALUES ({', '.join(['?'] * (len(column_names) + 1))})"
+            while True:
+                batch = list(itertools.islice(rows, loader_batch_size))
+                if not batch:
+                    break
+                connection.executemany(insert_sql, [tuple(row) + (self.row_hash(header, row),) for row in batch])
+                row_count += len(batch)
+            connection.execute("CREATE INDEX temp._snapshot_by_row_hash ON _snapshot (_row_hash)")
+
+            closed = connection.execute(f"UPDATE {table_name} SET _valid_to = ? WHERE _valid_to IS NULL "
+                                        f"AND _row_hash NOT IN (SELECT _row_hash FROM temp._snapshot)",
+                                        (date,)).rowcount
+            inserted = connection.execute(f"INSERT INTO {table_name} ({column_list}, _valid_from, _row_hash) "
+                                          f"SELECT {column_list}, ?, _row_hash FROM temp._snapshot "
+                                          f"WHERE _row_hash NOT IN (SELECT _row_hash FROM {table_name} "
+                                          f"WHERE _valid_to IS NULL)", (date,)).rowcount
+        finally:
+            connection.execute("DROP TABLE temp._snapshot")
+        return row_count, inserted, closed
+
+    @staticmethod
+    def row_hash(header, row):
+        return hashlib.sha1((header + repr(tuple(row))).encode('utf-8')).digest()
+
+    @staticmethod
+    def as_of(date, table_names):
+        # WITH clause shadowing the tables with their rows valid on a date, so a query put after it reads the tables
+        # as they were on that date. The rowid is kept for the queries ordering by it.
+        date = datetime.date.fromisoformat(date).isoformat()  # Checked, as it is written in the SQL
+        return "WITH " + ", ".join(f"{table_name} AS (SELECT rowid, * FROM main.{table_name} "
+                                   f"WHERE _valid_from <= '{date}' AND (_valid_to IS NULL OR _valid_to > '{date}'))"
+                                   for table_name in table_names) + " "
+
+
+class MergedDatabaseReader:
+    # Read side of the merged databases. Keeps one read-only connection per database, for the pool_size databases
+    # used last, so repeated queries don't open the file again. A database replaced by a rebuild is reopened.
+    def __init__(self, pool_size=reader_pool_size, mmap_size=reader_mmap_size):
+        self.pool_size = pool_size
+        self.mmap_size = mmap_size
+        self.connections = OrderedDict()
+        self.lock = threading.Lock()
+
+    def connect(self, database_path):
+        database_path = os.path.abspath(database_path)
+        file_stat = os.stat(database_path)
+        file_id = (file_stat.st_ino, file_stat.st_mtime_ns)
+
+        with self.lock:
+            if database_path in self.connections:
+                connection, connection_file_id = self.connections.pop(database_path)
+                if connection_file_id == file_id:
+                    self.connections[database_path] = (connection, file_id)
+                    return connection
+                connection.close()
+
+            # Steps run on a thread pool, so the connection isn't tied to the thread that opened it
+            connection = sqlite3.connect(pathlib.Path(database_path).as_uri() + "?mode=ro", uri=True,
+                                         check_same_thread=False)
+            connection.execute(f"PRAGMA mmap_size={self.mmap_size};")
+            self.connections[database_path] = (connection, file_id)
+
+            # Least recently used first
+            while len(self.connections) > self.pool_size:
+                _, (oldest_connection, _) = self.connections.popitem(last=False)
+                oldest_connection.close()
+            return connection
+
+    def columns(self, database_path, table_name):
+        # Column names of a table, without the columns the warehouse keeps the history of the rows in
+        connection = self.connect(database_path)
+        with self.lock:
+            column_names = [column[1] for column in connection.execute(f"PRAGMA table_info({table_name})")
+                            if column[1] not in warehouse_columns]
+        if not column_names:
+            raise Exception(f"no such table: {table_name}")
+        return column_names
+
+    def fetch(self, database_path, query, parameters=()):
+        # Returns the rows of a query as a Table
+        connection = self.connect(database_path)
+        with self.lock:
+            cursor = connection.execute(query, parameters)
+            try:
+                return Table([description[0] for description in cursor.description], cursor.fetchall())
+            finally:
+                cursor.close()
+
+    def stream(self, database_path, query, parameters=(), fetch_size=reader_fetch_size):
+        # Same as fetch, but the rows of the Table are read fetch_size at a time while they are iterated,
+        # so the result is never in memory as a whole
+        connection = self.connect(database_path)
+        with self.lock:
+            cursor = connection.execute(query, parameters)
+            column_names = [description[0] for description in cursor.description]
+
+        def records():
+            try:
+                while True:
+                    with self.lock:
+                        rows = cursor.fetchmany(fetch_size)
+                    if not rows:
+                        break
+                    yield from rows
+            finally:
+                with self.lock:
+                    cursor.close()
+
+        return Table(column_names, records())
+
+    def close(self):
+        with self.lock:
+            while self.connections:
+                _, (connection, _) = self.connections.popitem()
+                connection.close()
 
 
 class DbInput:
@@ -499,56 +2184,349 @@ class DbInput:
 
     def fetch_and_save_all_data(self):
         try:
-            # Create a cursor
-            cursor = self.connection.cursor()
-
             # Get a list of all table names from the information schema
-            cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema='public';")
-            table_names = cursor.fetchall()
+            table_names = self.fetch_table_names()
+            self.connection.commit()
 
             # Initialize a dictionary to store the data
             all_data = {}
 
             # Fetch and store data from all tables
-            for table in table_names:
-                table_name = table[0]
-                query = f"SELECT * FROM {table_name};"
-                cursor.execute(query)
-                result = cursor.fetchall()
-
-                # Get the column names
-                column_names = [desc[0] for desc in cursor.description]
-
-                # Convert datetime.date objects to strings
-                formatted_rows = []
-                for row in result:
-                    formatted_row = {}
-                    for i, value in enumerate(row):
-                        if isinstance(value, datetime.date):
-                            formatted_row[column_names[i]] = value.strftime("%Y-%m-%d")
-                        else:
-                            formatted_row[column_names[i]] = value
-                    formatted_rows.append(formatted_row)
+            for table_name in table_names:
+                rows = self.extract_table(table_name, self.connection, "memory")
+                if rows is None:
+                    # Dumped straight to disk, step 1.2 has nothing left to write for this table
+                    self.data_saver.streamed_tables.append(table_name)
+                else:
+                    all_data[table_name] = rows
 
-                # Store formatted rows in the dictionary
-                all_data[table_name] = formatted_rows
+            return True, all_data
+        except Exception as e:
+            logging.error(e)
+            return False, None
 
-            # Close cursor
+    def stream_and_save_all_data(self, batch_size=extraction_batch_size):
+        # Streams every table to disk in batches of batch_size rows. Peak memory depends on the batch size,
+        # not on the table size.
+        try:
+            table_names = self.fetch_table_names()
+            self.connection.commit()
+
+            for table_name in table_names:
+                self.extract_table(table_name, self.connection, "stream", batch_size)
+
+            return True, table_names
+        except Exception as e:
+            logging.error(e)
+            return False, None
+
+    def parallel_fetch_and_save_all_data(self, workers, mode=extraction_mode, batch_size=extraction_batch_size):
+        # Extracts the tables concurrently, each worker taking its own connection from a bounded pool.
+        # The tables are read from a single exported snapshot, so the parallel dumps still match each other.
+        psycopg2 = import_psycopg2()
+        connection_pool = None
+        try:
+            self.connection.rollback()
+            self.connection.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ,
+                                        readonly=True)
+            cursor = self.connection.cursor()
+            cursor.execute("SELECT pg_export_snapshot();")
+            snapshot_id = cursor.fetchone()[0]
             cursor.close()
+
+            table_names = self.fetch_table_names()
+
+            connection_pool = psycopg2.pool.ThreadedConnectionPool(1, workers, **db_params)
+            all_data = {}
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(self.extract_table_in_snapshot, connection_pool, snapshot_id, table_name,
+                                           mode, batch_size) for table_name in table_names]
+                for future in as_completed(futures):
+                    table_name, rows = future.result()
+                    if rows is None:
+                        self.data_saver.streamed_tables.append(table_name)
+                    else:
+                        all_data[table_name] = rows
+
             return True, all_data
         except Exception as e:
             logging.error(e)
             return False, None
+        finally:
+            if connection_pool is not None:
+                connection_pool.closeall()
+            # The exported snapshot only lives as long as this transaction, so it is released last
+            self.connection.rollback()
+            self.connection.set_session(isolation_level='DEFAULT', readonly='DEFAULT')
+
+    def extract_table_in_snapshot(self, connection_pool, snapshot_id, table_name, mode, batch_size):
+        connection = connection_pool.getconn()
+        try:
+            connection.set_session(isolation_level=import_psycopg2().extensions.ISOLATION_LEVEL_REPEATABLE_READ,
+                                   readonly=True)
+            cursor = connection.cursor()
+            cursor.execute("SET TRANSACTION SNAPSHOT %s;", (snapshot_id,))
+            cursor.close()
+
+            return table_name, self.extract_table(table_name, connection, mode, batch_size)
+        finally:
+            connection_pool.putconn(connection)
+
+    def extract_table(self, table_name, connection, mode, batch_size=extraction_batch_size):
+        # Returns the rows of the table in memory mode, or None when the table was already written to disk
+        if self.data_saver.partition_is_checkpointed("postgres", table_name):
+            logging.info(f"Table {table_name} was already written by an interrupted run, skipping it.")
+            return None
+
+        rows = None
+        with self.data_saver.metrics.measure('extract', table_name) as measurement:
+            try:
+                engine = self.engine_for(table_name)
+
+                table_state = None
+                if self.data_saver.incremental_extraction:
+                    if connection.info.transaction_status == import_psycopg2().extensions.TRANSACTION_STATUS_IDLE:
+                        # The fingerprint and the extracted rows have to come from the same snapshot
+                        cursor = connection.cursor()
+                        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;")
+                        cursor.close()
+
+                    table_state = self.fetch_table_state(table_name, connection, engine)
+                    if self.extract_changes_only(table_name, connection, table_state):
+                        self.data_saver.extraction_state.set(table_name, table_state)
+                        connection.commit()
+                        return None
+
+                if engine == "copy":
+                    self.copy_table_to_file(table_name, connection)
+                elif mode == "stream":
+                    batches = self.stream_table(table_name, connection, batch_size)
+                    try:
+                        if not self.data_saver.write_rows_to_file("postgres", batches, table_name=table_name):
+                            raise Exception(f"Couldn't stream table {table_name} to disk.")
+                    finally:
+                        # Closes the server-side cursor before the transaction ends
+                        batches.close()
+                else:
+                    rows = self.fetch_table(table_name, connection)
+                    measurement['rows'] = len(rows)
+
+                if table_state is not None:
+                    self.data_saver.extraction_state.set(table_name, table_state)
+            except Exception:
+                connection.rollback()
+                raise
+
+            connection.commit()
+        return rows
+
+    def extract_changes_only(self, table_name, connection, table_state):
+        # Returns True when today's partition could be built from the previous one
+        previous_state = self.data_saver.extraction_state.get(table_name)
+        if (previous_state is None or previous_state['extension'] != table_state['extension']
+                or not os.path.exists(previous_state['partition'])):
+            return False
+
+        if (previous_state['row_count'], previous_state['checksum']) == (table_state['row_count'],
+                                                                         table_state['checksum']):
+            # Nothing changed, so today's partition points to the previous one
+            if previous_state['partition'] != table_state['partition']:
+                self.link_partition(previous_state['partition'], table_name, table_state['extension'])
+            logging.info(f"Table {table_name} didn't change since {previous_state['date']}, reusing its partition.")
+            return True
+
+        key = table_state['key']
+        if (key is None or key != previous_state['key'] or previous_state['watermark'] is None
+                or previous_state['date'] == table_state['date']):
+            return False
+
+        # If the rows up to the previous high-water mark are the same, the table only got new rows
+        cursor = connection.cursor()
+        old_rows_condition = cursor.mogrify(f"WHERE {key} <= %s OR {key} IS NULL",
+                                            (previous_state['watermark'],)).decode('utf-8')
+        new_rows_condition = cursor.mogrify(f"WHERE {key} > %s", (previous_state['watermark'],)).decode('utf-8')
+        cursor.close()
+
+        row_count, checksum, _ = self.fingerprint_table(table_name, connection, key, old_rows_condition)
+        if (row_count, checksum) != (previous_state['row_count'], previous_state['checksum']):
+            return False
+
+        if table_state['extension'] == "csv":
+            self.copy_table_to_file(table_name, connection, new_rows_condition, previous_state['partition'])
+        else:
+            previous_rows = self.data_saver.read_rows_from_file(previous_state['partition'])
+            new_rows = self.fetch_table(table_name, connection, new_rows_condition)
+            if not self.data_saver.write_rows_to_file("postgres", [previous_rows, new_rows], table_name=table_name):
+                raise Exception(f"Couldn't write table {table_name} to disk.")
+
+        logging.info(f"Table {table_name} got {table_state['row_count'] - row_count} new rows since "
+                     f"{previous_state['date']}, extracted only those.")
+        return True
+
+    def fetch_table_state(self, table_name, connection, engine):
+        key = incremental_keys.get(table_name) or self.find_incremental_key(table_name, connection)
+        row_count, checksum, watermark = self.fingerprint_table(table_name, connection, key)
+        extension = "csv" if engine == "copy" else self.data_saver.landing_format
+
+        now = datetime.datetime.now()
+        return {
+            'date': now.strftime("%Y-%m-%d"),
+            'partition': DataSaver.partition_file("postgres", table_name, extension),
+            'extension': extension,
+            'row_count': row_count,
+            'checksum': checksum,
+            'key': key,
+            # Anything that isn't an integer (like timestamps) is kept as text and cast back by Postgres
+            'watermark': watermark if watermark is None or isinstance(watermark, int) else str(watermark)
+        }
+
+    @staticmethod
+    def fingerprint_table(table_name, connection, key=None, condition=""):
+        # The checksum is computed by Postgres, so the rows never leave the server.
+        # The row hashes are sorted, so the checksum doesn't depend on the physical order of the rows.
+        cursor = connection.cursor()
+        try:
+            cursor.execute(f"SELECT count(*), md5(string_agg(md5(t::text), '' ORDER BY md5(t::text))), "
+                           f"{f'max({key})' if key else 'NULL'} FROM {table_name} AS t {condition};")
+            return cursor.fetchone()
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def find_incremental_key(table_name, connection):
+        # Only a single integer primary key works as a high-water mark
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SELECT a.attname, a.atttypid FROM pg_index i "
+                           "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) "
+                           "WHERE i.indrelid = %s::regclass AND i.indisprimary;", (table_name,))
+            primary_key = cursor.fetchall()
+        finally:
+            cursor.close()
+
+        if len(primary_key) == 1 and primary_key[0][1] in (20, 21, 23):
+            return primary_key[0][0]
+        return None
+
+    def link_partition(self, previous_path, table_name, extension):
+        file_path = self.data_saver.partition_path("postgres", table_name, extension=extension)
+        if os.path.exists(file_path + ".tmp"):
+            os.remove(file_path + ".tmp")
+        try:
+            os.link(previous_path, file_path + ".tmp")
+        except OSError:
+            # Hard links aren't supported everywhere
+            shutil.copyfile(previous_path, file_path + ".tmp")
+
+        # Same content as the previous partition, so its row count and checksum still hold
+        previous_partition = self.data_saver.manifest.find_path(previous_path)
+        if previous_partition is None:
+            self.data_saver.commit_partition("postgres", file_path)
+        else:
+            self.data_saver.commit_partition("postgres", file_path, previous_partition['row_count'],
+                                             previous_partition['checksum'])
+
+    def fetch_table(self, table_name, connection, condition=""):
+        cursor = connection.cursor()
+        try:
+            query = f"SELECT * FROM {table_name} {condition};"
+            cursor.execute(query)
+            result = cursor.fetchall()
+
+            return self.format_rows(cursor.description, result)
+        finally:
+            cursor.close()
+
+    def stream_table(self, table_name, connection, batch_size):
+        # A named cursor lives on the server, so only batch_size rows are sent over at a time
+        cursor = connection.cursor(name=f"stream_{table_name}")
+        cursor.itersize = batch_size
+        try:
+            cursor.execute(f"SELECT * FROM {table_name};")
+            while True:
+                result = cursor.fetchmany(batch_size)
+                if not result:
+                    break
+                # The description of a named cursor is only available after the first fetch
+                yield self.format_rows(cursor.description, result)
+        finally:
+            cursor.close()
+
+    def copy_table_to_file(self, table_name, connection, condition="", previous_path=None):
+        # COPY sends the table already serialized, so no Python object is built per row.
+        # With previous_path, the rows are appended to a copy of that partition.
+        with self.data_saver.metrics.measure('write', table_name) as measurement:
+            cursor = connection.cursor()
+            try:
+                cursor.execute("SET DateStyle TO ISO;")
+
+                file_path = self.data_saver.partition_path("postgres", table_name, extension="csv")
+                if previous_path is None:
+                    # Write the column names and types first, so step 2 knows how to parse the values back
+                    cursor.execute(f"SELECT * FROM {table_name} LIMIT 0;")
+                    header = ",".join(
+                        f"{desc[0]}:{copy_column_types.get(desc[1], 'str')}" for desc in cursor.description)
+                    with open(file_path + ".tmp", "wb") as csv_file:
+                        csv_file.write((header + "\n").encode('utf-8'))
+                else:
+                    shutil.copyfile(previous_path, file_path + ".tmp")
+
+                with open(file_path + ".tmp", "ab") as csv_file:
+                    cursor.copy_expert(
+                        f"COPY (SELECT * FROM {table_name} {condition}) TO STDOUT "
+                        f"WITH (FORMAT csv, NULL '{copy_null_value}');",
+                        csv_file)
+                row_count = cursor.rowcount
+            finally:
+                cursor.close()
+
+            if previous_path is not None:
+                previous_partition = self.data_saver.manifest.find_path(previous_path)
+                row_count = None if previous_partition is None or previous_partition['row_count'] is None \
+                    else previous_partition['row_count'] + row_count
+            self.data_saver.commit_partition("postgres", file_path, row_count)
+            measurement['rows'], measurement['bytes'] = row_count, os.path.getsize(file_path)
+
+    def engine_for(self, table_name):
+        engines = self.data_saver.extraction_engines
+        return engines.get(table_name, engines["default"])
+
+    def fetch_table_names(self):
+        # Get a list of all table names from the information schema
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema='public';")
+        table_names = [table[0] for table in cursor.fetchall()]
+        cursor.close()
+        return table_names
+
+    @staticmethod
+    def format_rows(description, result):
+        # Keeps the rows as tuples in a Table. The column types come from the type codes of cursor.description,
+        # so only the date columns are converted, to strings.
+        column_names = [column[0] for column in description]
+        column_types = [postgres_column_types.get(column[1], 'TEXT') for column in description]
+        date_positions = [position for position, column in enumerate(description)
+                          if column[1] in postgres_date_types]
+        if not date_positions:
+            return Table(column_names, result, column_types)
+
+        records = []
+        for row in result:
+            row = list(row)
+            for position in date_positions:
+                if row[position] is not None:
+                    row[position] = row[position].strftime("%Y-%m-%d")
+            records.append(tuple(row))
+        return Table(column_names, records, column_types)
 
     def connect_db(self):
         # Establish a connection to the database
-        connection = psycopg2.connect(**db_params)
+        connection = import_psycopg2().connect(**db_params)
         return connection
 
 
 def main(data_saver):
     while True:
-        time.sleep(1)
         print("|- Indicium Code Challenge -|")
         print("| 1. Run steps sequentially |")
         print("| 2. Run individual step    |")
@@ -578,28 +2556,210 @@ def main(data_saver):
             logging.error("Couldn't complete the task. Catastrophic error occurred.")
 
 
-if __name__ == '__main__':
-
-    parser = argparse.ArgumentParser(description='Indicium Code Challenge Pipeline')
+def date_argument(value):
+    # Dates given on the command line are checked by argparse, which exits with status 2 when they are invalid
+    try:
+        return datetime.date.fromisoformat(value).isoformat()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date: {value} (expected YYYY-MM-DD)")
+
+
+def option_parsers(defaults=True):
+    # The options are grouped in parent parsers, shared by the commands and by the flags of the original command line.
+    # Without defaults, an option that isn't given isn't set at all.
+    def default(value):
+        return value if defaults else argparse.SUPPRESS
+
+    extraction_options = argparse.ArgumentParser(add_help=False)
+    extraction_options.add_argument('--extraction-mode', help='How to extract the Postgres tables in step 1.1 '
+                                                              '("memory" or "stream").',
+                                    choices=['memory', 'stream'], default=default(extraction_mode), required=False)
+    extraction_options.add_argument('--batch-size', help='Rows fetched per batch when streaming the Postgres tables.',
+                                    type=int, default=default(extraction_batch_size), required=False)
+    extraction_options.add_argument('--engine', help='Extraction engine used for every Postgres table '
+                                                     '("rows" or "copy").',
+                                    choices=['rows', 'copy'], default=default(extraction_engines['default']),
+                                    required=False)
+    extraction_options.add_argument('--table-engine', help='Extraction engine for a single table, like orders=copy. '
+                                                           'Can be repeated.',
+                                    action='append', default=default([]), required=False)
+    extraction_options.add_argument('--workers', help='Number of Postgres tables extracted at the same time.',
+                                    type=int, default=default(extraction_workers), required=False)
+    extraction_options.add_argument('--incremental', help='Only extract the Postgres tables (or rows) that changed '
+                                                          'since the last run.',
+                                    action='store_true', default=default(incremental_extraction), required=False)
+    extraction_options.add_argument('--landing-format', help='Format of the files written to ./data '
+                                                             '("json" or "parquet").',
+                                    choices=['json', 'parquet'], default=default(landing_format), required=False)
+
+    loading_options = argparse.ArgumentParser(add_help=False)
+    loading_options.add_argument('--loader-workers', help='Number of processes loading the partitions in step 2.1.',
+                                 type=int, default=default(loader_workers), required=False)
+
+    storage_options = argparse.ArgumentParser(add_help=False)
+    storage_options.add_argument('--storage-mode', help='Build a merged database per date ("date"), or apply every '
+                                                        'date to a single warehouse that can be queried as of any '
+                                                        'date ("warehouse").',
+                                 choices=['date', 'warehouse'], default=default(storage_mode), required=False)
+
+    query_options = argparse.ArgumentParser(add_help=False)
+    query_options.add_argument('--customer', help='Only query the orders of this customer_id.',
+                               default=default(None), required=False)
+    query_options.add_argument('--order-date-from', help='Only query the orders placed on or after this date.',
+                               type=date_argument, default=default(None), required=False)
+    query_options.add_argument('--order-date-to', help='Only query the orders placed on or before this date.',
+                               type=date_argument, default=default(None), required=False)
+    query_options.add_argument('--shipped-from', help='Only query the orders shipped on or after this date.',
+                               type=date_argument, default=default(None), required=False)
+    query_options.add_argument('--shipped-to', help='Only query the orders shipped on or before this date.',
+                               type=date_argument, default=default(None), required=False)
+    query_options.add_argument('--page', help='Only query this page of orders, starting at 1.', type=int,
+                               default=default(None), required=False)
+    query_options.add_argument('--page-size', help='Orders per page for --page.',
+                               type=int, default=default(query_page_size), required=False)
+    query_options.add_argument('--query-format', help='Format of the query output ("json" or "jsonl").',
+                               choices=['json', 'jsonl'], default=default(query_output_format), required=False)
+    query_options.add_argument('--compression', help='Compress the query output ("gzip" or "zstd").',
+                               choices=['gzip', 'zstd'], default=default(query_output_compression), required=False)
+
+    metrics_options = argparse.ArgumentParser(add_help=False)
+    metrics_options.add_argument('--metrics-format', help='Format of the metrics saved in ./metrics after every run.',
+                                 choices=['json', 'prometheus'], default=default(metrics_format), required=False)
+    metrics_options.add_argument('--trace-memory', help='Also measure the peak memory of every step and table '
+                                                        '(several times slower).',
+                                 action='store_true', default=default(metrics_trace_memory), required=False)
+
+    compaction_options = argparse.ArgumentParser(add_help=False)
+    compaction_options.add_argument('--retention-days', help='Days of partitions kept in ./data as they are.',
+                                    type=int, default=default(data_retention_days), required=False)
+    compaction_options.add_argument('--archive-period', help='Period of the partitions archived together.',
+                                    choices=['week', 'month'], default=default(archive_period), required=False)
+
+    return {'extraction': extraction_options, 'loading': loading_options, 'storage': storage_options,
+            'query': query_options, 'metrics': metrics_options, 'compaction': compaction_options}
+
+
+def build_argument_parser():
+    parser = argparse.ArgumentParser(description='Indicium Code Challenge Pipeline',
+                                     parents=list(option_parsers().values()))
     parser.add_argument('--reprocess', help='Date for reprocessing data (YYYY-MM-DD)', required=False)
+    parser.add_argument('--backfill', help='Rebuild the merged databases of a date range (YYYY-MM-DD YYYY-MM-DD).',
+                        nargs=2, metavar=('START', 'END'), required=False)
+    parser.add_argument('--backfill-workers', help='Number of dates rebuilt at the same time by --backfill.',
+                        type=int, default=backfill_workers, required=False)
     parser.add_argument('--sequentially', help='Execute steps sequentially (1 to 3)', action='store_true',
                         required=False)
     parser.add_argument('--individually', help='Execute steps individually. Choose a step (1 to 3).', required=False)
     parser.add_argument('--query', help='Date for query orders (YYYY-MM-DD). Date can be empty too.',
                         action='store_true', required=False)
-    args = parser.parse_args()
+    parser.add_argument('--date', help='Date of the database queried by --query (YYYY-MM-DD).', type=date_argument,
+                        required=False)
+    parser.add_argument('--compact', help='Move the partitions older than --retention-days into compressed archives.',
+                        action='store_true', required=False)
 
-    data_saver = DataSaver()
+    # Commands: a single part of the pipeline, without prompting. Their options have no defaults, so the options
+    # given before the command are kept, and the ones given after it replace them.
+    options = option_parsers(defaults=False)
+    commands = parser.add_subparsers(dest='command', title='commands',
+                                     description='Run a part of the pipeline without the menu and without prompting. '
+                                                 'The exit status is 0 on success, 1 on failure and 2 on invalid '
+                                                 'arguments.')
+    commands.add_parser('extract', help='Extract the Postgres tables and the CSV to ./data (step 1).',
+                        parents=[options['extraction'], options['metrics']])
+    load_command = commands.add_parser('load', help='Merge the partitions of a date (the latest by default) into its '
+                                                    'database (step 2).',
+                                       parents=[options['loading'], options['storage'], options['metrics']])
+    load_command.add_argument('--date', help='Date of the partitions to merge (YYYY-MM-DD).', type=date_argument,
+                              default=argparse.SUPPRESS, required=False)
+    query_command = commands.add_parser('query', help='Query the orders of a date (step 3).',
+                                        parents=[options['query'], options['storage'], options['metrics']])
+    query_command.add_argument('--date', help='Date of the database to query (YYYY-MM-DD).', type=date_argument,
+                               required=True)
+    backfill_command = commands.add_parser('backfill', help='Rebuild the merged databases of a date range.',
+                                           parents=[options['storage'], options['metrics']])
+    backfill_command.add_argument('start', help='First date (YYYY-MM-DD).', type=date_argument)
+    backfill_command.add_argument('end', help='Last date (YYYY-MM-DD).', type=date_argument)
+    backfill_command.add_argument('--workers', help='Number of dates rebuilt at the same time.',
+                                  dest='backfill_workers', type=int, default=argparse.SUPPRESS, required=False)
+    commands.add_parser('compact', help='Move the old partitions of ./data into compressed archives.',
+                        parents=[options['compaction'], options['metrics']])
+    return parser
+
+
+def configure_data_saver(data_saver, args, parser):
+    data_saver.extraction_mode = args.extraction_mode
+    data_saver.extraction_batch_size = args.batch_size
+    data_saver.extraction_workers = args.workers
+    data_saver.incremental_extraction = args.incremental
+    data_saver.query_output_format = args.query_format
+    data_saver.query_output_compression = args.compression
+    data_saver.landing_format = args.landing_format
+    data_saver.loader_workers = args.loader_workers
+    data_saver.storage_mode = args.storage_mode
+    data_saver.metrics.output_format = args.metrics_format
+    data_saver.metrics.trace_memory = args.trace_memory
+    data_saver.extraction_engines['default'] = args.engine
+    for table_engine in args.table_engine:
+        table, separator, engine = table_engine.partition('=')
+        if not separator or not table:
+            parser.error(f"Invalid --table-engine {table_engine} (expected TABLE=ENGINE, like orders=copy)")
+        if engine not in ('rows', 'copy'):
+            parser.error(f"Invalid engine for table {table}: {engine}")
+        data_saver.extraction_engines[table] = engine
+
+
+def query_filters(args):
+    return {'customer_id': args.customer, 'order_date_from': args.order_date_from,
+            'order_date_to': args.order_date_to, 'shipped_date_from': args.shipped_from,
+            'shipped_date_to': args.shipped_to, 'page': args.page, 'page_size': args.page_size}
+
+
+def run_command(data_saver, args):
+    # Runs a command of the command line, returning True when it succeeded.
+    # The metrics of what it ran are saved when it ends, like after every run of the steps.
+    try:
+        if args.command == 'extract':
+            return all(data_saver.run_step(data_saver.find_step(1)).values())
+        elif args.command == 'load':
+            if args.date is not None:
+                return data_saver.reprocess_data(args.date)
+            return all(data_saver.run_step(data_saver.find_step(2)).values())
+        elif args.command == 'query':
+            return data_saver.query_orders(date=args.date, **query_filters(args))
+        elif args.command == 'backfill':
+            return data_saver.backfill(args.start, args.end, args.backfill_workers)
+        elif args.command == 'compact':
+            return data_saver.compact_data(args.retention_days, args.archive_period)
+
+        # The flags of the original command line
+        if args.reprocess:
+            # Reprocess data for a specific date
+            return data_saver.reprocess_data(args.reprocess)
+        elif args.backfill:
+            return data_saver.backfill(args.backfill[0], args.backfill[1], args.backfill_workers)
+        elif args.compact:
+            return data_saver.compact_data(args.retention_days, args.archive_period)
+        elif args.sequentially:
+            return data_saver.run_steps_sequentially()
+        elif args.individually:
+            return data_saver.run_individual_step(args.individually)
+        elif args.query:
+            filters = query_filters(args)
+            if args.date is None and all(value is None for name, value in filters.items() if name != 'page_size'):
+                return data_saver.run_individual_step(3)
+            return data_saver.query_orders(date=args.date, **filters)
 
-    if args.reprocess:
-        # Reprocess data for a specific date
-        data_saver.reprocess_data(args.date)
-    elif args.sequentially:
-        data_saver.run_steps_sequentially()
-    elif args.individually:
-        data_saver.run_individual_step(args.individually)
-    elif args.query:
-        data_saver.run_individual_step(3)
-    else:
         # Run the pipeline for the current day
         main(data_saver)
+        return True
+    finally:
+        data_saver.metrics.save()
+
+
+if __name__ == '__main__':
+    argument_parser = build_argument_parser()
+    arguments = argument_parser.parse_args()
+
+    pipeline = DataSaver()
+    configure_data_saver(pipeline, arguments, argument_parser)
+    sys.exit(0 if run_command(pipeline, arguments) else 1)